@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+DESCRIPTION = \
+"""
+This script compares the upload modes of camio_hooks.py by posting a video file repeatedly to a local
+stand-in for the Camio Box /box/content endpoint. It reports the throughput and the CPU time the uploading
+process spent in each mode, so you can decide whether to set 'upload_mode' in your hook data.
+"""
+
+EXAMPLES = \
+"""
+Example:
+
+    Post a 1 GB scratch file 5 times in each mode:
+
+    python benchmark_upload.py --size_mb 1024 --count 5
+
+    Post one of your own videos instead:
+
+    python benchmark_upload.py --count 3 ~/input_videos/camera1-1493554642.mp4
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import textwrap
+import resource
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+
+import camio_hooks
+
+READ_CHUNK_BYTES = 1024 * 1024
+
+class StandInBoxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ accepts and discards POSTed content the way the Box /box/content endpoint would """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining > 0:
+            data = self.rfile.read(min(READ_CHUNK_BYTES, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInBoxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(server):
+    server.serve_forever()
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def benchmark(mode, url, filepath, count):
+    camio_hooks.CAMIO_PARAMS['upload_mode'] = mode
+    size = os.path.getsize(filepath)
+    start_time, start_cpu = time.time(), cpu_seconds()
+    for _ in range(count):
+        response = camio_hooks.post_file(url, filepath)
+        if response.status_code not in (200, 204):
+            camio_hooks.fail("stand-in server returned %r", response.status_code)
+    elapsed, cpu = time.time() - start_time, cpu_seconds() - start_cpu
+    logging.info("%-10s %8.1f MB/s  %6.2f CPU seconds  (%d x %.1f MB in %.2f seconds)",
+                 mode, size * count / 1e6 / elapsed, cpu, count, size / 1e6, elapsed)
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=textwrap.dedent(DESCRIPTION), epilog=EXAMPLES)
+    parser.add_argument('filepath', nargs='?', type=str, help='the file to post (default: a scratch file of --size_mb)')
+    parser.add_argument('-s', '--size_mb', type=int, default=512, help='size of the scratch file to post (default = 512)')
+    parser.add_argument('-n', '--count', type=int, default=3, help='number of times to post the file in each mode (default = 3)')
+    args = parser.parse_args()
+    camio_hooks.set_hook_data({})
+
+    filepath = args.filepath
+    if not filepath:
+        fd, filepath = tempfile.mkstemp(suffix='.mp4')
+        with os.fdopen(fd, 'wb') as fh:
+            for _ in range(args.size_mb):
+                fh.write(os.urandom(1024 * 1024))
+
+    # run the stand-in in its own process so its CPU time isn't counted against the uploads
+    server = StandInBoxServer(('127.0.0.1', 0), StandInBoxHandler)
+    process = multiprocessing.Process(target=serve, args=(server,))
+    process.daemon = True
+    process.start()
+    url = "http://127.0.0.1:%d/box/content?hash=benchmark" % server.server_address[1]
+    try:
+        for mode in ('requests', camio_hooks.UPLOAD_MODE_SENDFILE):
+            benchmark(mode, url, filepath, args.count)
+    finally:
+        process.terminate()
+        if not args.filepath:
+            os.remove(filepath)
+
+if __name__ == '__main__':
+    main()
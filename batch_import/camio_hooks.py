@@ -11,7 +11,24 @@ import logging
 import logging
 import hashlib
 import datetime
+import sqlite3
+import threading
+import atexit
+import random
+import Queue
+import socket
+import ctypes
+import ctypes.util
+import httplib
+import urlparse
+import collections
+import itertools
+import cPickle
+import tempfile
+import bisect
+import heapq
 import requests
+from multiprocessing.pool import ThreadPool
 
 """
 Camio-specific hook examples for use with the video import script
@@ -34,9 +51,82 @@ CAMIO_BOX_DEVICE_ID_ENVVAR = "CAMIO_BOX_DEVICE_ID"
 # if posting to box fails, wait this long before trying again
 POST_FAILURE_RETRY_SECONDS = 25
 
+# on-disk cache of file content hashes (override with 'hash_cache_file' in the hook data,
+# set it to an empty string to disable the cache)
+HASH_CACHE_DEFAULT_FILE = os.path.join(os.path.expanduser('~'), '.camio_hash_cache.db')
+HASH_CACHE_DEFAULT_MAX_ENTRIES = 1000000
+
+# how many files to hash ahead of the one being posted, and with how many workers
+# (override with 'hash_prefetch_depth' and 'hash_prefetch_workers', a depth of 0 disables prefetching)
+HASH_PREFETCH_DEFAULT_DEPTH = 4
+HASH_PREFETCH_DEFAULT_WORKERS = 2
+
+# how many posts to keep in flight to each Box (override with 'upload_concurrency' in the hook data,
+# the default of 1 posts one file at a time and waits for it). With more than one, the in-flight
+# limit starts at 2 and adapts to the Box's 429 responses, never going above 'upload_concurrency'
+UPLOAD_DEFAULT_CONCURRENCY = 1
+UPLOAD_INITIAL_CONCURRENCY = 2
+# when the Box answers 429 we pause that file for this long, doubling per retry up to the max
+UPLOAD_RATE_LIMIT_SLEEP_SECONDS = 2
+UPLOAD_RATE_LIMIT_MAX_SLEEP_SECONDS = 60
+UPLOAD_MAX_RATE_LIMITS = 10
+
+# set 'upload_mode' to 'sendfile' in the hook data to have the kernel copy files straight from disk
+# to the socket instead of streaming them through the requests library
+UPLOAD_MODE_SENDFILE = 'sendfile'
+SENDFILE_CHUNK_BYTES = 8 * 1024 * 1024
+# how long to wait for the Box's answer when it stops taking a file half-way (e.g. to send us a 429)
+SENDFILE_EARLY_RESPONSE_SECONDS = 5
+
+# append-only journal of the state of every posted file (override with 'upload_journal_file' in the
+# hook data, set it to an empty string to disable it). Files that fail are retried in the background
+# up to 'upload_retry_attempts' times, waiting exponentially longer before each retry
+UPLOAD_JOURNAL_DEFAULT_FILE = os.path.join(os.path.expanduser('~'), '.camio_upload_journal')
+UPLOAD_RETRY_DEFAULT_ATTEMPTS = 5
+UPLOAD_RETRY_SECONDS = 60
+UPLOAD_RETRY_MAX_SECONDS = 3600
+
+# set 'metrics_file' in the hook data to have upload metrics rewritten to that file this often, in
+# Prometheus text format if the name ends with .prom and json otherwise. Set 'metrics_summary' to
+# true to log a summary of them when the import exits
+METRICS_WRITE_SECONDS = 10
+
+# when uploads are shaped with 'upload_rate_limit' in the hook data, content is sent in chunks of this
+# size so that the token bucket can pace it smoothly
+SHAPED_CHUNK_BYTES = 256 * 1024
+
+# set 'multi_box' to true in the hook data to spread the files over all the Boxes on the account, with
+# a job of its own for each Box. The field of the Box state holding its backlog of content to segment
+# can be overridden with 'box_queue_state_key'
+BOX_QUEUE_STATE_KEY = 'batch_queue_length'
+# weight of the latest response in each Box's running 429 rate
+BOX_RATE_LIMIT_EWMA_ALPHA = 0.2
+
+# sqlite database of the files scheduled in each job (override with 'job_store_file' in the hook data,
+# set it to an empty string to only keep the importer's own database)
+JOB_STORE_DEFAULT_FILE = os.path.join(os.path.expanduser('~'), '.camio_jobs.db')
+
+# upload status of files in the job store's content index. Files whose content was already posted
+# (under any path or job) are skipped, unless 'skip_duplicates' is set to false in the hook data
+CONTENT_REGISTERED = 'registered'
+CONTENT_POSTED = 'posted'
+
+# the most shards of a job that register_jobs registers with the server at the same time
+REGISTER_JOBS_MAX_CONCURRENCY = 16
+
+# how files are spread over the shards of a job (override with 'shard_balance' in the hook data),
+# 'bytes' gives each shard a similar amount of data to upload, 'count' a similar number of files
+SHARD_BALANCE_BYTES = 'bytes'
+SHARD_BALANCE_COUNT = 'count'
+
 # handle to logger
 Log = None
 
+# after registering cameras, poll for their configs this often (doubling up to the max) until the timeout
+CAMERA_CONFIG_POLL_SECONDS = 1
+CAMERA_CONFIG_POLL_MAX_SECONDS = 30
+CAMERA_CONFIG_POLL_TIMEOUT_SECONDS = 300
+
 # plan definitions for actual_values entry
 CAMIO_PLANS = { 'pro': 'PRO', 'plus': 'PLUS', 'basic': 'BASIC' }
 
@@ -98,6 +188,10 @@ def get_account_info():
             fail('no Camio Box devices found on your account, have you registered your Box yet?')
         elif len(devices) == 1:
             device_id = devices[0]['device_id']
+        elif CAMIO_PARAMS.get('multi_box'):
+            # content is spread over all Boxes, each with a job of its own, the first one is the one that
+            # registers the cameras (their content is then posted by whichever Box holds it)
+            device_id = devices[0]['device_id']
         else: # multiple devices, prompt for which one they want
             lines = ["%d. %s" % (index+1, device.get('name', 'unknown')) for (index, device) in enumerate(devices)]
             prompt = "\nMultiple Camio Box devices belong to your account. Please select the one you wish to use\n"
@@ -141,6 +235,374 @@ def hash_file_in_chunks(fh, chunksize=65536):
         sha1.update(data)
     return sha1.hexdigest()
 
+class UploadMetrics(object):
+    """
+    counters and timings of the work done by the hooks, to tell whether an import is held up by the
+    disk or CPU (hashing), by the network (posting) or by the Box (rate-limits and back-off)
+    """
+
+    COUNTERS = (
+        ('files_hashed', 'files read and hashed'),
+        ('hash_cache_hits', 'files whose hash came from the hash cache'),
+        ('bytes_hashed', 'bytes read and hashed'),
+        ('hash_seconds', 'seconds spent hashing files'),
+        ('posts', 'posts to a Box'),
+        ('bytes_posted', 'bytes of content accepted by a Box'),
+        ('post_seconds', 'seconds spent posting content'),
+        ('rate_limited', 'posts a Box answered with 429'),
+        ('post_errors', 'posts that failed with another status or a connection error'),
+        ('backoff_seconds', 'seconds spent sleeping before retrying a post'),
+        ('shaping_seconds', 'seconds uploads were held back by the upload rate limit'),
+    )
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = dict((name, 0) for (name, description) in self.COUNTERS)
+        self.max_post_seconds = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def post_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def post_finished(self, size, seconds, status_code):
+        with self.lock:
+            self.in_flight -= 1
+            self.counters['posts'] += 1
+            self.counters['post_seconds'] += seconds
+            self.max_post_seconds = max(self.max_post_seconds, seconds)
+            if status_code in (200, 204):
+                self.counters['bytes_posted'] += size
+            elif status_code == 429:
+                self.counters['rate_limited'] += 1
+            else:
+                self.counters['post_errors'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            snapshot = dict(self.counters, elapsed_seconds=elapsed, in_flight=self.in_flight,
+                            max_post_seconds=self.max_post_seconds)
+        posts = snapshot['posts'] or 1
+        snapshot['average_post_seconds'] = snapshot['post_seconds'] / posts
+        snapshot['posted_bytes_per_second'] = snapshot['bytes_posted'] / elapsed if elapsed else 0
+        snapshot['hashed_bytes_per_second'] = \
+            snapshot['bytes_hashed'] / snapshot['hash_seconds'] if snapshot['hash_seconds'] else 0
+        return snapshot
+
+    def prometheus(self):
+        """ the metrics in the Prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = []
+        for name, description in self.COUNTERS:
+            lines.append("# HELP camio_import_%s_total %s" % (name, description))
+            lines.append("# TYPE camio_import_%s_total counter" % name)
+            lines.append("camio_import_%s_total %s" % (name, snapshot[name]))
+        for name in ('in_flight', 'max_post_seconds', 'posted_bytes_per_second', 'hashed_bytes_per_second'):
+            lines.append("# TYPE camio_import_%s gauge" % name)
+            lines.append("camio_import_%s %s" % (name, snapshot[name]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """ atomically rewrite $filename with the current metrics """
+        if filename.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            fh.write(content)
+        os.rename(tmpname, filename)
+
+    def summary(self):
+        snapshot = self.snapshot()
+        Log.info("import summary after %.0f seconds:", snapshot['elapsed_seconds'])
+        Log.info("\thashed %d files (%.1f MB) in %.1f seconds, %d hashes from the cache",
+                 snapshot['files_hashed'], snapshot['bytes_hashed'] / 1e6, snapshot['hash_seconds'],
+                 snapshot['hash_cache_hits'])
+        Log.info("\t%d posts, %.1f MB accepted at %.2f MB/s, %.2f seconds per post on average (max %.2f)",
+                 snapshot['posts'], snapshot['bytes_posted'] / 1e6, snapshot['posted_bytes_per_second'] / 1e6,
+                 snapshot['average_post_seconds'], snapshot['max_post_seconds'])
+        Log.info("\t%d rate-limited posts, %d failed posts, %.0f seconds of back-off, %.0f seconds of rate limiting",
+                 snapshot['rate_limited'], snapshot['post_errors'], snapshot['backoff_seconds'],
+                 snapshot['shaping_seconds'])
+
+Metrics = UploadMetrics()
+
+def write_metrics_periodically():
+    while True:
+        time.sleep(METRICS_WRITE_SECONDS)
+        write_metrics()
+
+def write_metrics():
+    filename = CAMIO_PARAMS.get('metrics_file')
+    if not filename:
+        return
+    try:
+        Metrics.write(os.path.expanduser(filename))
+    except (IOError, OSError), e:
+        Log.error("unable to write metrics to file: %s", filename)
+        Log.error(traceback.format_exc())
+
+def finish_metrics():
+    write_metrics()
+    if CAMIO_PARAMS.get('metrics_summary'):
+        Metrics.summary()
+
+def backoff_sleep(seconds):
+    """ sleep before retrying a post, counting the time as back-off """
+    Metrics.add('backoff_seconds', seconds)
+    time.sleep(seconds)
+
+_metrics_writer = threading.Thread(target=write_metrics_periodically, name="metrics-writer")
+_metrics_writer.daemon = True
+_metrics_writer.start()
+
+class HashCache(object):
+    """
+    on-disk index of file content hashes keyed by (path, size, mtime, inode) so that a file that
+    hasn't changed since it was last hashed only costs a stat() to look up again. The least recently
+    used entries are evicted once the index grows past $max_entries.
+    """
+
+    # number of writes to batch up into a single sqlite transaction
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, filename, max_entries=HASH_CACHE_DEFAULT_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.pending_writes = 0
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, "
+                          "mtime REAL, inode INTEGER, sha1 TEXT, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def signature(path):
+        """ returns the (size, mtime, inode) tuple for $path or None if it can't be stat'd """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime, st.st_ino
+
+    @staticmethod
+    def path_key(path):
+        """
+        $path as it is stored in the index: the exact bytes of the file name, as sqlite refuses
+        8-bit byte strings as text and a lossy decode could map two different files onto one key
+        """
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        return sqlite3.Binary(path)
+
+    def lookup(self, path, signature=None):
+        """ return the cached SHA1 of $path if the file is unchanged since it was hashed, else None """
+        signature = signature or self.signature(path)
+        if not signature:
+            return None
+        key = self.path_key(path)
+        with self.lock:
+            row = self.conn.execute("SELECT sha1 FROM hashes WHERE path=? AND size=? AND mtime=? AND inode=?",
+                                    (key,) + signature).fetchone()
+            if not row:
+                return None
+            self.conn.execute("UPDATE hashes SET last_used=? WHERE path=?", (time.time(), key))
+            self._wrote()
+        return row[0]
+
+    def store(self, path, sha1, signature=None):
+        signature = signature or self.signature(path)
+        if not signature:
+            return
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO hashes (path, size, mtime, inode, sha1, last_used) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (self.path_key(path),) + signature + (sha1, time.time()))
+            self._wrote()
+
+    def _wrote(self):
+        """ commit every COMMIT_INTERVAL writes and evict old entries if the index got too big """
+        self.pending_writes += 1
+        if self.pending_writes < self.COMMIT_INTERVAL:
+            return
+        count = self.conn.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+        if count > self.max_entries:
+            Log.debug("evicting %d entries from hash cache: %s", count - self.max_entries, self.filename)
+            self.conn.execute("DELETE FROM hashes WHERE path IN "
+                              "(SELECT path FROM hashes ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+        self.conn.commit()
+        self.pending_writes = 0
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending_writes = 0
+
+_hash_cache = None
+_hash_cache_lock = threading.Lock()
+
+def get_hash_cache():
+    """ returns the HashCache handle, or None if the cache is disabled through the hook data """
+    global _hash_cache
+    filename = CAMIO_PARAMS.get('hash_cache_file', HASH_CACHE_DEFAULT_FILE)
+    if not filename:
+        return None
+    with _hash_cache_lock:
+        if not _hash_cache:
+            _hash_cache = open_hash_cache(filename)
+    return _hash_cache
+
+def open_hash_cache(filename):
+    max_entries = int(CAMIO_PARAMS.get('hash_cache_max_entries', HASH_CACHE_DEFAULT_MAX_ENTRIES))
+    try:
+        cache = HashCache(os.path.expanduser(filename), max_entries)
+    except sqlite3.Error, e:
+        Log.error("unable to open hash cache (%s), hashing without it", filename)
+        Log.error(traceback.format_exc())
+        CAMIO_PARAMS['hash_cache_file'] = None
+        return None
+    atexit.register(cache.flush)
+    return cache
+
+def get_file_hash(filepath):
+    """ get the SHA1 of $filepath, only reading the file if the hash cache doesn't know it yet """
+    cache = get_hash_cache()
+    signature = HashCache.signature(filepath)
+    try:
+        filehash = cache.lookup(filepath, signature) if cache else None
+    except sqlite3.Error, e:
+        Log.error("hash cache lookup failed for file: %s, hashing it instead", filepath)
+        Log.error(traceback.format_exc())
+        filehash = None
+    if filehash:
+        Log.debug("using cached hash for file: %s", filepath)
+        Metrics.add('hash_cache_hits')
+        return filehash
+    started = time.time()
+    with open(filepath, 'rb') as fh:
+        filehash = hash_file_in_chunks(fh)
+    Metrics.add('hash_seconds', time.time() - started)
+    Metrics.add('files_hashed')
+    Metrics.add('bytes_hashed', signature[0] if signature else 0)
+    if cache:
+        try:
+            cache.store(filepath, filehash, signature)
+        except sqlite3.Error, e:
+            Log.error("unable to store hash of file: %s in the hash cache", filepath)
+            Log.error(traceback.format_exc())
+    return filehash
+
+class PathSpool(object):
+    """ the paths of the files to prefetch in upload order, kept in a temporary file instead of in memory """
+
+    def __init__(self):
+        self.count = 0
+        self.spill = tempfile.TemporaryFile(prefix='camio_prefetch_')
+
+    def add(self, path):
+        cPickle.dump(path, self.spill, cPickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        self.spill.flush()
+        self.spill.seek(0)
+        while True:
+            try:
+                yield cPickle.load(self.spill)
+            except EOFError:
+                break
+
+    def close(self):
+        self.spill.close()
+
+class HashPrefetcher(object):
+    """
+    hashes the files queued for upload ahead of post_video_content so that reading the next files
+    off disk overlaps with the network POST of the current one. At most $depth upcoming files are
+    hashed (or waiting to be hashed) at any time, and $paths is only read that far ahead, so any
+    iterable (e.g. a PathSpool) works and the prefetcher's memory doesn't grow with the import.
+    We use threads rather than processes here as hashlib and file reads both release the GIL.
+    """
+
+    def __init__(self, paths, depth=HASH_PREFETCH_DEFAULT_DEPTH, workers=HASH_PREFETCH_DEFAULT_WORKERS):
+        self.paths = paths
+        self.upcoming = iter(paths)
+        self.depth = depth
+        self.pool = ThreadPool(workers)
+        # path => hashing result of the files in the window, in upload order
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def _fill(self):
+        """ queue up hashing of the next files until $depth are pending (must hold self.lock) """
+        while len(self.pending) < self.depth:
+            path = next(self.upcoming, None)
+            if path is None:
+                break
+            self.pending[path] = self.pool.apply_async(get_file_hash, (path,))
+
+    def start(self):
+        with self.lock:
+            self._fill()
+
+    def get(self, path):
+        """ returns the hash of $path if it was prefetched (waiting for it to finish), else None """
+        with self.lock:
+            if path not in self.pending:
+                # the importer has moved past the window (e.g. it skipped files), so start the window over
+                # from the files after $path if it's coming up shortly, or else from the next files queued
+                Log.debug("file (%s) isn't among the %d prefetched files, moving the prefetch window on",
+                          path, len(self.pending))
+                self.pending.clear()
+                for queued in itertools.islice(self.upcoming, self.depth):
+                    if queued == path:
+                        break
+                self._fill()
+                return None
+            # drop handles to files before $path that were never asked for, their hashes still land in the hash cache
+            while True:
+                queued, result = self.pending.popitem(last=False)
+                if queued == path:
+                    break
+            self._fill()
+        try:
+            return result.get()
+        except Exception, e:
+            Log.error("prefetched hashing of file (%s) failed", path)
+            Log.error(traceback.format_exc())
+            return None
+
+    def close(self):
+        self.pool.terminate()
+        if hasattr(self.paths, 'close'):
+            self.paths.close()
+
+_hash_prefetcher = None
+
+def start_hash_prefetch(paths):
+    """ start hashing $paths (any iterable with a length, in upload order) ahead of post_video_content """
+    global _hash_prefetcher
+    depth = int(CAMIO_PARAMS.get('hash_prefetch_depth', HASH_PREFETCH_DEFAULT_DEPTH))
+    workers = int(CAMIO_PARAMS.get('hash_prefetch_workers', HASH_PREFETCH_DEFAULT_WORKERS))
+    if depth <= 0 or not paths:
+        return None
+    if _hash_prefetcher:
+        _hash_prefetcher.close()
+    Log.debug("prefetching hashes of %d files, depth=%d, workers=%d", len(paths), depth, workers)
+    _hash_prefetcher = HashPrefetcher(paths, depth, workers)
+    _hash_prefetcher.start()
+    return _hash_prefetcher
+
 def get_access_token():
     if not CAMIO_PARAMS.get('access_token'):
         token = os.environ.get(CAMIO_OAUTH_TOKEN_ENVVAR)
@@ -155,6 +617,15 @@ def dateshift(timestamp, seconds, format = "%Y-%m-%dT%H:%M:%S.%f"):
     date = date + datetime.timedelta(seconds=seconds)
     return date.strftime(format)
 
+def parse_timestamp(timestamp):
+    """
+    the datetime for an importer timestamp like '2017-04-30T05:17:22.551', same as the strptime()
+    call in dateshift() but by slicing, which is a lot faster when done for every file of a job
+    """
+    return datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                             int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                             int(timestamp[20:23].ljust(6, '0')))
+
 def get_device_id(fail=True):
     """ if fail we exit if the ID cannot be located """
     device = None
@@ -209,14 +680,44 @@ def get_camera_image_resolutions(camera_name):
         actual_values[item] = dict(options=[{'name': item, 'value': value}])
     return actual_values
 
-def get_camera_config(local_camera_id):
-    access_token = get_access_token()
-    headers = {"Authorization": "token %s" % access_token}
+_camera_configs = {}
+_registered_cameras = set()
+_camera_lock = threading.RLock()
+
+def refresh_camera_configs():
+    """ download the map of discovered cameras under the account into the local cache """
     url = CAMIO_SERVER_URL + CAMIO_REGISTER_ENDPOINT
     response = network_request('get', url)
     response = response.json()
     Log.debug("cameras under account:\n%r", [response[camera].get('name') for camera in response])
-    return response[local_camera_id]
+    with _camera_lock:
+        _camera_configs.update(response)
+    return _camera_configs
+
+def wait_for_camera_configs(local_camera_ids):
+    """
+    poll the discovered-camera map until all of $local_camera_ids show up in it, backing off between
+    polls. returns True if they all did before CAMERA_CONFIG_POLL_TIMEOUT_SECONDS ran out.
+    """
+    delay = CAMERA_CONFIG_POLL_SECONDS
+    deadline = time.time() + CAMERA_CONFIG_POLL_TIMEOUT_SECONDS
+    while True:
+        refresh_camera_configs()
+        missing = [local_camera_id for local_camera_id in local_camera_ids if local_camera_id not in _camera_configs]
+        if not missing:
+            return True
+        if time.time() + delay > deadline:
+            Log.error("%d cameras still not registered after %d seconds", len(missing), CAMERA_CONFIG_POLL_TIMEOUT_SECONDS)
+            return False
+        Log.info("waiting %d seconds for %d new cameras to be registered", delay, len(missing))
+        time.sleep(delay)
+        delay = min(delay * 2, CAMERA_CONFIG_POLL_MAX_SECONDS)
+
+def get_camera_config(local_camera_id):
+    """ returns the config of a discovered camera, only downloading the camera map if it isn't cached """
+    if local_camera_id not in _camera_configs:
+        refresh_camera_configs()
+    return _camera_configs[local_camera_id]
 
 def generate_actual_values(camera_name):
     camera_plan = get_camera_plan(camera_name)
@@ -251,13 +752,22 @@ def register_camera(camera_name, port=None, host=None):
                  input source.
                  Note that the host and port are not used by Camio. This is because we don't register
                  cameras with the segmenter
+                 Only the camera the importer found is registered here, cameras that failed to register
+                 are tried again on the next call. Callers that know all the cameras of an import up front
+                 can register them in a single POST with register_cameras().
     """
-    ip_address, device_id = get_account_info()
-    access_token = get_access_token()
+    with _camera_lock:
+        if camera_name not in _registered_cameras:
+            register_cameras([camera_name])
+    local_camera_id = hashlib.sha1(camera_name).hexdigest()
+    return get_camera_config(local_camera_id)
+
+def camera_payload(camera_name, device_id):
+    """ the entry describing $camera_name in the POST to /api/cameras/discovered """
     user_agent = "video-importer script"
     local_camera_id = hashlib.sha1(camera_name).hexdigest()
     actual_values = generate_actual_values(camera_name)
-    payload = dict(
+    return dict(
             device_id_discovering=device_id,
             acquisition_method='batch',
             device_user_agent=user_agent,
@@ -269,18 +779,551 @@ def register_camera(camera_name, port=None, host=None):
             is_authenticated=True,
             should_config=True # toggles the camera 'ON'
     )
-    Log.info("registering camera: name=%s, local_camera_id=%s", camera_name, local_camera_id)
-    payload = {local_camera_id: payload}
-    headers = {"Authorization": "token %s" % access_token}
-    url = CAMIO_SERVER_URL + CAMIO_REGISTER_ENDPOINT
-    response = network_request('post', url, json=payload)
+
+def register_cameras(camera_names):
+    """
+    register all of $camera_names with a single POST to /api/cameras/discovered, then poll the
+    discovered-camera map once (with backoff) until they all show up.
+    returns a dictionary of camera_name => camera config (None for cameras that never showed up)
+    """
+    ip_address, device_id = get_account_info()
+    with _camera_lock:
+        payload = {}
+        for camera_name in set(camera_names) - _registered_cameras:
+            local_camera_id = hashlib.sha1(camera_name).hexdigest()
+            Log.info("registering camera: name=%s, local_camera_id=%s", camera_name, local_camera_id)
+            payload[local_camera_id] = camera_payload(camera_name, device_id)
+        if payload:
+            url = CAMIO_SERVER_URL + CAMIO_REGISTER_ENDPOINT
+            response = network_request('post', url, json=payload)
+            if response is None or response.status_code not in (200, 204):
+                # left unregistered so the next call tries them again
+                Log.error("error registering %d cameras: %r", len(payload), response)
+            else:
+                _registered_cameras.update(payload[local_camera_id]['name'] for local_camera_id in payload)
+                wait_for_camera_configs(payload.keys())
+        return dict((camera_name, _camera_configs.get(hashlib.sha1(camera_name).hexdigest()))
+                    for camera_name in camera_names)
+
+class UploadShaper(object):
+    """
+    token bucket limiting the bytes per second sent to the Boxes, shared by all uploads in the process.
+    The rate follows a daily schedule given as 'upload_rate_limit' in the hook data, either a single
+    number of bytes per second or a list of windows in local time such as
+        [{"start": "08:00", "end": "18:00", "bytes_per_second": 2000000}]
+    where windows may wrap around midnight and outside of any window uploads are not limited.
+    """
+
+    def __init__(self, schedule):
+        if isinstance(schedule, (int, long, float)):
+            schedule = [{"start": "00:00", "end": "24:00", "bytes_per_second": schedule}]
+        self.windows = [(self._minutes(window['start']), self._minutes(window['end']), window.get('bytes_per_second'))
+                        for window in schedule]
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _minutes(clock):
+        hours, minutes = clock.split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def rate(self, now=None):
+        """ returns the bytes per second allowed at $now (a timestamp), None meaning no limit """
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.windows:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return None
+
+    def consume(self, count):
+        """ take $count bytes worth of tokens, sleeping as long as it takes for them to be available """
+        with self.lock:
+            now = time.time()
+            rate = self.rate(now)
+            if not rate:
+                self.updated = now
+                return
+            # allow at most a second of burst, and go into debt for the rest so callers queue up fairly
+            self.tokens = min(float(rate), self.tokens + (now - self.updated) * rate) - count
+            self.updated = now
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay > 0:
+            Metrics.add('shaping_seconds', delay)
+            time.sleep(delay)
+
+class ShapedFile(object):
+    """ wraps an open file so that reading it (e.g. by requests while posting it) is paced by $shaper """
+
+    def __init__(self, fh, shaper):
+        self.fh = fh
+        self.shaper = shaper
+        self.size = os.fstat(fh.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > SHAPED_CHUNK_BYTES:
+            size = SHAPED_CHUNK_BYTES
+        data = self.fh.read(size)
+        self.shaper.consume(len(data))
+        return data
+
+_upload_shaper = None
+
+def get_upload_shaper():
+    """ returns the UploadShaper if 'upload_rate_limit' is set in the hook data, else None """
+    global _upload_shaper
+    schedule = CAMIO_PARAMS.get('upload_rate_limit')
+    if not schedule:
+        return None
+    if not _upload_shaper:
+        _upload_shaper = UploadShaper(schedule)
+    return _upload_shaper
+
+def post_file(url, filepath, session=requests):
+    """ POST the content of $filepath to $url, returns the response """
+    Metrics.post_started()
+    started = time.time()
+    response = None
+    try:
+        if CAMIO_PARAMS.get('upload_mode') == UPLOAD_MODE_SENDFILE:
+            response = sendfile_post(url, filepath)
+        else:
+            shaper = get_upload_shaper()
+            with open(filepath, 'rb') as fh:
+                response = session.post(url, data=ShapedFile(fh, shaper) if shaper else fh)
+        return response
+    finally:
+        Metrics.post_finished(os.path.getsize(filepath), time.time() - started,
+                              response.status_code if response is not None else None)
+
+# the parts of a response that callers of post_file() look at when using sendfile_post()
+SendfileResponse = collections.namedtuple('SendfileResponse', ['status_code', 'text'])
+
+def _find_sendfile():
+    """
+    returns a sendfile(out_fd, in_fd, offset, count) function that returns the number of bytes sent.
+    Python 2 has no os.sendfile so on Linux we call into libc, other platforms get None
+    and fall back to sending from a reused buffer.
+    """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
     try:
-        config = get_camera_config(local_camera_id)
-    except:
-        Log.info("key error for new camera, waiting 15 seconds to retry")
-        time.sleep(15)
-        config = get_camera_config(local_camera_id)
-    return config
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc.sendfile.restype = ctypes.c_ssize_t
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = libc.sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return sent
+    return sendfile
+
+_sendfile = _find_sendfile()
+
+def _send_file_body(sock, fh, size):
+    offset = 0
+    shaper = get_upload_shaper()
+    chunk_bytes = SHAPED_CHUNK_BYTES if shaper else SENDFILE_CHUNK_BYTES
+    if _sendfile:
+        while offset < size:
+            count = min(chunk_bytes, size - offset)
+            if shaper:
+                shaper.consume(count)
+            sent = _sendfile(sock.fileno(), fh.fileno(), offset, count)
+            if sent == 0:
+                raise IOError("file (%s) shrank while posting it" % fh.name)
+            offset += sent
+        return
+    buf = bytearray(chunk_bytes)
+    view = memoryview(buf)
+    while offset < size:
+        count = fh.readinto(buf)
+        if not count:
+            raise IOError("file (%s) shrank while posting it" % fh.name)
+        if shaper:
+            shaper.consume(count)
+        sock.sendall(view[:count])
+        offset += count
+
+def _read_response(sock):
+    response = httplib.HTTPResponse(sock)
+    response.begin()
+    return SendfileResponse(response.status, response.read())
+
+def sendfile_post(url, filepath):
+    """
+    POST the content of $filepath to $url over a plain HTTP/1.1 connection, letting the kernel
+    copy the file to the socket so the data never passes through python buffers.
+    Only http:// urls are supported (which is all the Box serves on the local network).
+    """
+    parsed = urlparse.urlsplit(url)
+    path = parsed.path + ('?' + parsed.query if parsed.query else '')
+    size = os.path.getsize(filepath)
+    try:
+        sock = socket.create_connection((parsed.hostname, parsed.port or 80))
+    except socket.error, e:
+        raise requests.exceptions.ConnectionError(e)
+    try:
+        with open(filepath, 'rb') as fh:
+            sock.sendall("POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/octet-stream\r\n"
+                         "Content-Length: %d\r\nConnection: close\r\n\r\n" % (path, parsed.netloc, size))
+            try:
+                _send_file_body(sock, fh, size)
+            except (OSError, IOError), e:
+                # the Box may have answered before taking the whole file and closed the connection,
+                # in which case its answer (usually a 429) is what the caller needs to see
+                Log.debug("sending file (%s) failed: %s, looking for an early response", filepath, e)
+                sock.settimeout(SENDFILE_EARLY_RESPONSE_SECONDS)
+                try:
+                    return _read_response(sock)
+                except (OSError, IOError, httplib.HTTPException):
+                    raise requests.exceptions.ConnectionError(e)
+        return _read_response(sock)
+    except requests.exceptions.ConnectionError:
+        raise
+    except (OSError, IOError, httplib.HTTPException), e:
+        raise requests.exceptions.ConnectionError(e)
+    finally:
+        sock.close()
+
+class AIMDLimit(object):
+    """
+    the number of posts allowed in flight to one Box. The limit grows by one for every window of
+    successful posts (additive increase) and is halved whenever the Box answers with a 429
+    (multiplicative decrease), so we settle just under the rate the Box can take content in.
+    """
+
+    def __init__(self, initial, maximum):
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, status_code=None):
+        with self.cond:
+            self.in_flight -= 1
+            if status_code == 429:
+                self.limit = max(1.0, self.limit / 2)
+                Log.debug("Box rate-limited, in-flight limit now %d", int(self.limit))
+            elif status_code in (200, 204):
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+class BoxUploader(object):
+    """
+    posts files to a single Box from a pool of worker threads, keeping as many posts in flight
+    as the AIMDLimit allows. Files are handed over with submit() and wait() blocks until every
+    submitted file has either been accepted by the Box or given up on.
+    """
+
+    def __init__(self, host, port, concurrency):
+        self.host = host
+        self.name = "%s:%s" % (host, port)
+        self.limit = AIMDLimit(UPLOAD_INITIAL_CONCURRENCY, concurrency)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        # bounded so the importer doesn't run arbitrarily far ahead of the uploads
+        self.queue = Queue.Queue(maxsize=concurrency)
+        self.failed = []
+        self.succeeded = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        for index in range(concurrency):
+            worker = threading.Thread(target=self._work, name="%s-upload-%d" % (self.name, index))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, url, filepath, filehash, target=None):
+        self.queue.put((url, filepath, filehash, target))
+
+    def wait(self):
+        self.queue.join()
+        return self.succeeded, list(self.failed)
+
+    def _work(self):
+        while True:
+            url, filepath, filehash, target = self.queue.get()
+            try:
+                success, reason = self._upload(url, filepath)
+            except Exception, e:
+                Log.error("unexpected error while posting file: %s", filepath)
+                Log.error(traceback.format_exc())
+                success, reason = False, "unexpected error: %s" % e
+            upload_finished(url, filepath, filehash, self.host, success, reason, target=target)
+            with self.lock:
+                if success:
+                    self.succeeded += 1
+                else:
+                    self.failed.append(filepath)
+            self.queue.task_done()
+
+    def _upload(self, url, filepath):
+        failed_attempts_left = 2
+        rate_limit_reached_counter = 0
+        while failed_attempts_left > 0:
+            self.limit.acquire()
+            response = None
+            try:
+                response = post_file(url, filepath, self.session)
+            except requests.exceptions.ConnectionError, e:
+                Log.error("connection error while contacting Box server (%s)", self.name)
+                Log.error(traceback.format_exc())
+            finally:
+                self.limit.release(response.status_code if response is not None else None)
+            record_box_response(self.host, response)
+            if response is None:
+                failed_attempts_left -= 1
+                backoff_sleep(30)
+            elif response.status_code in (200, 204):
+                Log.debug("posted video content: file=%s", filepath)
+                return True, None
+            elif response.status_code == 429:
+                rate_limit_reached_counter += 1
+                if rate_limit_reached_counter >= UPLOAD_MAX_RATE_LIMITS:
+                    Log.error("unable to post content after %d retries, failing: %s", rate_limit_reached_counter, filepath)
+                    return False, "rate-limited %d times" % rate_limit_reached_counter
+                # the in-flight limit already backed off, so only pause this file for a short, jittered while
+                sleep_time = min(UPLOAD_RATE_LIMIT_MAX_SLEEP_SECONDS,
+                                 UPLOAD_RATE_LIMIT_SLEEP_SECONDS * (2 ** (rate_limit_reached_counter - 1)))
+                backoff_sleep(sleep_time * random.uniform(0.5, 1.0))
+            else:
+                Log.error("error returned from Box when posting video: %s", filepath)
+                Log.error("%r: %r", response, response.text)
+                return False, "Box returned %d: %s" % (response.status_code, response.text)
+        return False, "unable to connect to Box"
+
+_box_uploaders = {}
+_box_uploaders_lock = threading.Lock()
+
+def get_box_uploader(host, port):
+    """ returns the BoxUploader for the Box at $host:$port, starting it if needed """
+    name = "%s:%s" % (host, port)
+    with _box_uploaders_lock:
+        if name not in _box_uploaders:
+            concurrency = int(CAMIO_PARAMS.get('upload_concurrency', UPLOAD_DEFAULT_CONCURRENCY))
+            Log.info("posting up to %d files at once to Box at %s", concurrency, name)
+            _box_uploaders[name] = BoxUploader(host, port, concurrency)
+    return _box_uploaders[name]
+
+def wait_for_uploads():
+    """ block until all files handed to the Box uploaders have been posted, returns True if all succeeded """
+    success = True
+    for name, uploader in _box_uploaders.items():
+        succeeded, failed = uploader.wait()
+        Log.info("Box %s: %d files posted, %d failed", name, succeeded, len(failed))
+        for filepath in failed:
+            Log.error("failed to post file to Box %s: %s", name, filepath)
+        success = success and not failed
+    return success
+
+class BoxBalancer(object):
+    """
+    splits the files of an import over all Boxes on the account, so that each Box gets a job of its own
+    (and with it the hash_map of every file it will be sent). Boxes are weighted by the backlog they report
+    in /api/devices/state/ and by the share of our recent posts they answered with 429, so busy or
+    rate-limiting Boxes get fewer files. As an import is planned before its first post, the 429 rates
+    are kept in the job store and carried over from the previous runs.
+    """
+
+    def __init__(self):
+        self.boxes = {}
+        # running 429 rate of each Box, by device_id
+        self.rate_limits = collections.defaultdict(float)
+        # Boxes we've already warned about a missing backlog field
+        self.warned = set()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """ re-read the Boxes on the account and their state """
+        ret = network_request('get', CAMIO_SERVER_URL + CAMIO_DEVICES_ENDPOINT)
+        devices = ret.json() if ret is not None and ret.status_code == 200 else []
+        queue_key = CAMIO_PARAMS.get('box_queue_state_key', BOX_QUEUE_STATE_KEY)
+        boxes = {}
+        for device in devices:
+            url = CAMIO_SERVER_URL + CAMIO_STATE_ENDPOINT + "?device_id=%s" % device['device_id']
+            ret = network_request('get', url)
+            if ret is None or ret.status_code != 200:
+                continue
+            state = ret.json().get('state') or {}
+            ip_address = (state.get('network_configuration_actual') or {}).get('ip_address')
+            if not ip_address:
+                Log.debug("skipping Box without an IP address: %s", device.get('name'))
+                continue
+            if queue_key not in state and device['device_id'] not in self.warned:
+                self.warned.add(device['device_id'])
+                Log.warn("Box %s doesn't report '%s' in its state, treating its backlog as empty "
+                         "(see 'box_queue_state_key')", device.get('name'), queue_key)
+            boxes[ip_address] = dict(device_id=device['device_id'], name=device.get('name'),
+                                     queue=state.get(queue_key) or 0)
+        saved_rates = get_job_store().box_rates()
+        with self.lock:
+            if boxes:
+                self.boxes = boxes
+            # Boxes we haven't posted to in this run start from the 429 rate of the previous runs
+            for box in boxes.values():
+                if box['device_id'] in saved_rates and box['device_id'] not in self.rate_limits:
+                    self.rate_limits[box['device_id']] = saved_rates[box['device_id']]
+        Log.debug("Boxes available for import:\n%s", pprint.pformat(boxes, indent=2))
+        return boxes
+
+    def weight(self, ip_address):
+        box = self.boxes[ip_address]
+        return max(0.05, 1.0 - self.rate_limits[box['device_id']]) / (1.0 + box['queue'])
+
+    def split(self, manifest):
+        """
+        split the files of $manifest into runs of consecutive files, one per Box and sized by its weight.
+        returns [((ip_address, device_id), JobManifest), ...] or None if no Box could be found
+        """
+        self.refresh()
+        # files are placed on Boxes the same way as on the shards of a job, with each Box's weight
+        # as its item_count and its device_id in place of the upload_url
+        with self.lock:
+            boxes = dict((ip_address, dict(item_count=self.weight(ip_address), upload_url=box['device_id']))
+                         for ip_address, box in self.boxes.items())
+        if not boxes:
+            return None
+        planner = ShardPlanner(boxes, manifest.total_bytes, manifest.count)
+        manifests = collections.OrderedDict()
+        for params in manifest.items():
+            box = planner.place(params['size'])
+            manifests.setdefault(box, JobManifest()).add(params)
+        return manifests.items()
+
+    def record(self, ip_address, status_code):
+        """ fold the response a Box gave to a post into its running 429 rate """
+        with self.lock:
+            box = self.boxes.get(ip_address)
+            if not box:
+                return
+            rate_limited = 1.0 if status_code == 429 else 0.0
+            device_id = box['device_id']
+            self.rate_limits[device_id] += BOX_RATE_LIMIT_EWMA_ALPHA * (rate_limited - self.rate_limits[device_id])
+
+    def save(self):
+        """ keep the 429 rates in the job store for the next run to plan with """
+        with self.lock:
+            rates = dict(self.rate_limits)
+        get_job_store().save_box_rates(rates)
+
+_box_balancer = None
+
+def get_box_balancer():
+    """ returns the BoxBalancer when 'multi_box' is set in the hook data, else None """
+    global _box_balancer
+    if not CAMIO_PARAMS.get('multi_box'):
+        return None
+    if not get_job_store():
+        # the job store is how post_video_content finds the Box a file was planned for
+        Log.warn("'multi_box' needs the job store ('job_store_file'), posting to a single Box")
+        CAMIO_PARAMS['multi_box'] = False
+        return None
+    if not _box_balancer:
+        _box_balancer = BoxBalancer()
+    return _box_balancer
+
+def planned_box(filehash):
+    """ returns the (ip_address, device_id) of the Box whose job holds the file with hash $filehash, or None """
+    store = get_job_store()
+    params = store.get(filehash) if store else None
+    if not params or not params.get('box_host'):
+        return None
+    return params['box_host'], params['box_device_id']
+
+def record_box_response(host, response):
+    balancer = _box_balancer
+    if balancer and response is not None:
+        balancer.record(host, response.status_code)
+
+def save_box_rates():
+    if _box_balancer:
+        _box_balancer.save()
+
+_duplicates = dict(count=0, bytes=0)
+
+def find_duplicate(filepath, filehash, targets):
+    """
+    returns the content index entry if a file with the same content as $filepath was already posted
+    to one of $targets (see upload_target())
+    """
+    store = get_job_store()
+    if not store or not CAMIO_PARAMS.get('skip_duplicates', True):
+        return None
+    entry = store.content(filehash, targets)
+    if not entry or entry[3] != CONTENT_POSTED:
+        return None
+    _duplicates['count'] += 1
+    _duplicates['bytes'] += os.path.getsize(filepath)
+    return entry
+
+def skip_posted_duplicates(files):
+    """
+    yields the params of $files minus the files already posted under another path or job, so they
+    never make it into a job's item_count or hash_map. Only files the hash cache knows are checked
+    here, the others are hashed (and checked) when they are posted.
+    """
+    cache = get_hash_cache()
+    targets = None
+    for params in files:
+        try:
+            filehash = cache.lookup(params['filename']) if cache else None
+        except sqlite3.Error, e:
+            Log.error("hash cache lookup failed for file: %s", params['filename'])
+            Log.error(traceback.format_exc())
+            filehash = None
+        if filehash and targets is None:
+            targets = planning_targets()
+        duplicate = find_duplicate(params['filename'], filehash, targets) if filehash else None
+        if duplicate:
+            job_id, shard_id, original_filename, status = duplicate
+            Log.info("not scheduling file: %s, same content as %s was already posted (job: %s, shard: %s)",
+                     params['filename'], original_filename, job_id, shard_id)
+            continue
+        yield params
+
+def planning_targets():
+    """ the targets (see upload_target()) the files of the job being planned can be posted to """
+    balancer = get_box_balancer()
+    boxes = balancer.refresh() if balancer else None
+    if boxes:
+        return [upload_target(box['device_id']) for box in boxes.values()]
+    return [upload_target(get_account_info()[1])]
+
+def content_posted(filepath, filehash, target):
+    store = get_job_store()
+    if store:
+        store.content_posted(filehash, filepath, target)
+
+def report_duplicates():
+    if _duplicates['count']:
+        Log.info("skipped %d files (%.1f MB) whose content was already posted",
+                 _duplicates['count'], _duplicates['bytes'] / 1e6)
+
+_warned_no_journal = []
+
+def warn_no_journal():
+    if not _warned_no_journal:
+        Log.warn("'upload_concurrency' needs the upload journal to keep track of failed files, "
+                 "posting files one at a time")
+        _warned_no_journal.append(True)
 
 def post_video_content(camera_name, camera_id, filepath, timestamp, host=None, port=None, location=None):
     """
@@ -302,46 +1345,81 @@ def post_video_content(camera_name, camera_id, filepath, timestamp, host=None, p
     host, device_id = get_account_info()
     if not port:
         port = BATCH_IMPORT_DEFAULT_PORT
-    with open(filepath, 'rb') as fh:
-        filehash = hash_file_in_chunks(fh)
+    if not os.path.exists(filepath):
+        Log.error("unable to locate video-file: %s, continuing", filepath)
+        return False
+    journal = get_upload_journal()
+    filehash = None
+    if get_box_balancer():
+        # the file goes to the Box its job was registered with, the only Box that knows its hash
+        filehash = (_hash_prefetcher and _hash_prefetcher.get(filepath)) or get_file_hash(filepath)
+        host, device_id = planned_box(filehash) or (host, device_id)
+    target = upload_target(device_id)
+    if posted_before(filepath, target):
+        Log.debug("file already posted to %s according to the upload journal: %s", target, filepath)
+        return True
+    filehash = filehash or (_hash_prefetcher and _hash_prefetcher.get(filepath)) or get_file_hash(filepath)
+    if journal:
+        journal.record(filepath, UploadJournal.HASHED, hash=filehash)
+    duplicate = find_duplicate(filepath, filehash, [target])
+    if duplicate:
+        job_id, shard_id, original_filename, status = duplicate
+        Log.info("skipping file: %s, same content as %s was already posted (job: %s, shard: %s)",
+                 filepath, original_filename, job_id, shard_id)
+        return True
     urlbase = "http://%s:%s" % (host, port)
     urlbase = urlbase + "/box/content"
     local_camera_id = hashlib.sha1(camera_name).hexdigest()
     urlparams = "access_token=%s&local_camera_id=%s&camera_id=%s&hash=%s&timestamp=%s" % (
         device_id, local_camera_id, camera_id, filehash, timestamp)
     url = urlbase + "?" + urlparams
-    if not os.path.exists(filepath):
-        Log.error("unable to locate video-file: %s, continuing", filepath)
-        return False
     Log.debug("posting video content: file=%s, camera=%s, timestamp=%s", filepath, camera_name, timestamp)
-    repsonse = None
+    if journal:
+        journal.record(filepath, UploadJournal.POSTING, hash=filehash, url=url, host=host, target=target)
+    if int(CAMIO_PARAMS.get('upload_concurrency', UPLOAD_DEFAULT_CONCURRENCY)) > 1:
+        if journal:
+            # the file is queued and posted in the background and the importer is told it succeeded,
+            # so the journal is what gets failures retried (now or on the next run)
+            get_box_uploader(host, port).submit(url, filepath, filehash, target)
+            return True
+        warn_no_journal()
+    success, reason = post_content(url, filepath, host)
+    upload_finished(url, filepath, filehash, host, success, reason, target=target)
+    return success
+
+def post_content(url, filepath, host):
+    """ post $filepath to a Box one attempt at a time, returns (success, reason for failure) """
     failed_attempts_left = 2 # 2 max failed attempts to contact server at all
     max_rate_limits_reached = 5 # 5 max back-off for space to open on Box
     rate_limit_reached_counter = 0
     sleep_time = 15 # seconds to sleep when rate-limit hit
     while failed_attempts_left > 0:
         try:
-            with open(filepath, 'rb') as fh:
-                response = requests.post(url, data=fh)
+            response = post_file(url, filepath)
+            record_box_response(host, response)
             if response.status_code in (200, 204):
-                return True
+                return True, None
             elif response.status_code == 400:
                 # bad arguments or bad hash
                 logging.error("error returned from Box when posting video")
                 logging.error("%r: %r", response, response.text) 
-                return False
+                return False, "Box returned 400: %s" % response.text
             elif response.status_code == 429:
                 # hit the rate-limiter, sleep for a while then try again. This
                 # isn't an error, we just need to slow down.
                 rate_limit_reached_counter += 1
                 if rate_limit_reached_counter >= max_rate_limits_reached:
                     Log.error("unable to post content after %d retries, failing..", max_rate_limits_reached)
-                    return False
+                    return False, "rate-limited %d times" % rate_limit_reached_counter
                 # exponential back-off on rate-limits, max waited = sum([15*(2^x) for x in range(0, 5)]) = 465 seconds
                 actual_sleep_time = sleep_time * (2 ** rate_limit_reached_counter)
                 Log.info("reached rate-limit of Box web-server")
                 Log.info("sleeping for %d seconds before retrying..", actual_sleep_time)
-                time.sleep(actual_sleep_time)
+                backoff_sleep(actual_sleep_time)
+            else:
+                Log.error("error returned from Box when posting video")
+                Log.error("%r: %r", response, response.text)
+                return False, "Box returned %d: %s" % (response.status_code, response.text)
         # this means we couldn't even contact the web-server, maybe it's taking some
         # time to wake up, so back off a bit
         except requests.exceptions.ConnectionError, e:
@@ -349,23 +1427,449 @@ def post_video_content(camera_name, camera_id, filepath, timestamp, host=None, p
             Log.error("sleeping to wait for server to wake up, %d more retries left", failed_attempts_left)
             Log.error(traceback.format_exc())
             failed_attempts_left -= 1
-            time.sleep(30)
+            backoff_sleep(30)
+
+    return False, "unable to connect to Box"
+
+class UploadJournal(object):
+    """
+    append-only log of the state each posted file went through (hashed, posting, done or failed with
+    a reason), one json object per line. Replaying it on start-up tells us which files are already done,
+    so a restarted import skips them straight away, and which ones still have to be retried.
+    """
 
-    return response and response.status_code in (200, 204)
+    HASHED = 'hashed'
+    POSTING = 'posting'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        lines = 0
+        if os.path.exists(filename):
+            with open(filename) as fh:
+                for line in fh:
+                    lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # most likely the last line, cut short by a crash
+                        Log.debug("skipping unreadable line in upload journal: %r", line)
+                        continue
+                    self.entries[entry['file']] = entry
+        if lines > 2 * len(self.entries) + 1000:
+            self.compact()
+        self.fh = open(filename, 'a')
+
+    def compact(self):
+        """ rewrite the journal with only the latest state of each file """
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            for entry in self.entries.values():
+                fh.write(json.dumps(entry) + '\n')
+        os.rename(tmpname, self.filename)
+
+    def record(self, filepath, state, **details):
+        entry = dict(details, time=time.time(), file=filepath, state=state)
+        with self.lock:
+            self.fh.write(json.dumps(entry) + '\n')
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.entries[filepath] = entry
+
+    def is_done(self, filepath, target):
+        """ True if $filepath was posted to $target (see upload_target()) and hasn't changed since """
+        entry = self.entries.get(filepath)
+        if not entry or entry['state'] != self.DONE or entry.get('target') != target:
+            return False
+        return entry.get('signature') == list(HashCache.signature(filepath) or [])
+
+    def unfinished(self):
+        """ the entries of files that failed or were being posted when the importer stopped """
+        return [entry for entry in self.entries.values()
+                if entry['state'] in (self.FAILED, self.POSTING) and entry.get('url')]
+
+class RetryQueue(object):
+    """
+    re-posts failed files from a background thread, each file waiting exponentially longer
+    before every new attempt
+    """
+
+    def __init__(self, max_attempts):
+        self.max_attempts = max_attempts
+        self.heap = []
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="upload-retries")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, url, filepath, filehash, host, attempts, target=None):
+        """ retry posting $filepath, which has failed $attempts times so far """
+        if attempts >= self.max_attempts:
+            Log.error("giving up on file after %d failed attempts: %s", attempts, filepath)
+            return
+        delay = min(UPLOAD_RETRY_MAX_SECONDS, UPLOAD_RETRY_SECONDS * (2 ** (attempts - 1)))
+        Log.info("retrying file in %d seconds: %s", delay, filepath)
+        with self.cond:
+            heapq.heappush(self.heap, (time.time() + delay, filepath, url, filehash, host, attempts, target))
+            self.cond.notify()
+
+    def cancel(self, filepath):
+        """ drop the queued retries of $filepath, e.g. once it got posted some other way """
+        with self.cond:
+            heap = [entry for entry in self.heap if entry[1] != filepath]
+            if len(heap) != len(self.heap):
+                heapq.heapify(heap)
+                self.heap = heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][0] > time.time():
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                due, filepath, url, filehash, host, attempts, target = heapq.heappop(self.heap)
+            journal = _upload_journal
+            if journal and journal.is_done(filepath, target):
+                Log.debug("not retrying file, it was posted in the meantime: %s", filepath)
+                continue
+            try:
+                success, reason = post_content(url, filepath, host)
+            except Exception, e:
+                Log.error(traceback.format_exc())
+                success, reason = False, "unexpected error: %s" % e
+            upload_finished(url, filepath, filehash, host, success, reason, attempts, target)
+
+_upload_journal = None
+_retry_queue = None
+_upload_journal_lock = threading.Lock()
+
+def get_upload_journal():
+    """ returns the UploadJournal (replaying it and queueing unfinished files on first use), or None if disabled """
+    global _upload_journal
+    filename = CAMIO_PARAMS.get('upload_journal_file', UPLOAD_JOURNAL_DEFAULT_FILE)
+    if not filename:
+        return None
+    with _upload_journal_lock:
+        if not _upload_journal:
+            _upload_journal = UploadJournal(os.path.expanduser(filename))
+            unfinished = _upload_journal.unfinished()
+            if unfinished:
+                Log.info("resuming %d unfinished uploads from journal: %s", len(unfinished), filename)
+            for entry in unfinished:
+                get_retry_queue().schedule(entry['url'], entry['file'], entry.get('hash'), entry.get('host'),
+                                           entry.get('attempts', 1), entry.get('target'))
+    return _upload_journal
+
+def get_retry_queue():
+    global _retry_queue
+    if not _retry_queue:
+        _retry_queue = RetryQueue(int(CAMIO_PARAMS.get('upload_retry_attempts', UPLOAD_RETRY_DEFAULT_ATTEMPTS)))
+    return _retry_queue
+
+def upload_target(device_id):
+    """
+    what files are posted to: the Camio server and the Box. The journal only skips a file it has seen
+    posted to the same target, so importing into another Box, account or server posts it again
+    """
+    return "%s/%s" % (CAMIO_SERVER_URL, device_id)
+
+def posted_before(filepath, target):
+    """ True if the upload journal says $filepath was posted to $target, unless 'skip_duplicates' is off """
+    journal = get_upload_journal()
+    if not journal or not CAMIO_PARAMS.get('skip_duplicates', True):
+        return False
+    return journal.is_done(filepath, target)
+
+def upload_finished(url, filepath, filehash, host, success, reason=None, attempts=0, target=None):
+    """ record the outcome of posting a file to $target, queueing it for a retry if it failed """
+    journal = get_upload_journal()
+    if success:
+        if _retry_queue:
+            _retry_queue.cancel(filepath)
+        content_posted(filepath, filehash, target)
+        if journal:
+            journal.record(filepath, UploadJournal.DONE, hash=filehash, target=target,
+                           signature=list(HashCache.signature(filepath) or []))
+        return
+    Log.error("failed to post file: %s (%s)", filepath, reason)
+    if journal:
+        journal.record(filepath, UploadJournal.FAILED, hash=filehash, url=url, host=host, target=target,
+                       reason=reason, attempts=attempts + 1)
+    get_retry_queue().schedule(url, filepath, filehash, host, attempts + 1, target)
+
+def report_retries():
+    if _retry_queue and len(_retry_queue):
+        Log.warn("%d failed files are still waiting to be retried, they will be retried the next time "
+                 "the importer runs", len(_retry_queue))
+
+# atexit calls these in reverse order: the uploads are drained first, so that files failing
+# during the drain still get reported and counted in the final metrics
+atexit.register(finish_metrics)
+atexit.register(save_box_rates)
+atexit.register(report_retries)
+atexit.register(report_duplicates)
+atexit.register(wait_for_uploads)
+
+
+class JobManifest(object):
+    """
+    running aggregates (earliest and latest date, item count, byte totals) over the files of a job,
+    built in a single pass over any iterable of file params. The params themselves are spilled to
+    a temporary file as they go by and streamed back with items(), so planning a job takes the same
+    amount of memory no matter how many files it has.
+    """
+
+    # length of the json {'key': .., 'original_filename': .., 'size_MB': ..} describing an item, minus
+    # its values. This lets us average the size of the items without json-encoding every one of them
+    ITEM_JSON_OVERHEAD = len(json.dumps({'key': '', 'original_filename': '', 'size_MB': 0})) - 1
+
+    def __init__(self, files=()):
+        self.count = 0
+        self.total_bytes = 0
+        self.total_json_bytes = 0
+        self.earliest_date = None
+        self.latest_datetime = None
+        self.spill = tempfile.TemporaryFile(prefix='camio_manifest_')
+        for params in files:
+            self.add(params)
+
+    def add(self, params):
+        if self.earliest_date is None or params['timestamp'] < self.earliest_date:
+            self.earliest_date = params['timestamp']
+        end = parse_timestamp(params['timestamp']) + datetime.timedelta(seconds=params['duration'])
+        if self.latest_datetime is None or end > self.latest_datetime:
+            self.latest_datetime = end
+        self.count += 1
+        self.total_bytes += params['size']
+        self.total_json_bytes += self.ITEM_JSON_OVERHEAD + len(params['key']) + len(params['filename']) + \
+            len(repr(params['size']/1e6))
+        cPickle.dump(params, self.spill, cPickle.HIGHEST_PROTOCOL)
+
+    @property
+    def latest_date(self):
+        return self.latest_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f") if self.latest_datetime else None
+
+    @property
+    def item_average_size_bytes(self):
+        return self.total_json_bytes / self.count if self.count else 0
+
+    def items(self):
+        """ stream the params of all added files back from disk, in the order they were added """
+        self.spill.flush()
+        self.spill.seek(0)
+        while True:
+            try:
+                yield cPickle.load(self.spill)
+            except EOFError:
+                break
+
+    def close(self):
+        self.spill.close()
+
+class ShardPlanner(object):
+    """
+    places the files of a job onto the shards of the server's shard_map. With 'bytes' balancing
+    every shard gets a share of the job's bytes in proportion to the item_count the server gave it,
+    so a shard of 4 GB files and a shard of 50 MB files take about as long to upload. Files are placed
+    in the order they are planned, so files close together in time end up on the same shard, and every
+    shard gets at least one file as long as the job has as many files as shards.
+    """
+
+    def __init__(self, shard_map, total_bytes, total_items, balance=SHARD_BALANCE_BYTES):
+        if balance == SHARD_BALANCE_BYTES and not total_bytes:
+            # there are no bytes to share out, so share out the files instead
+            balance = SHARD_BALANCE_COUNT
+        self.balance = balance
+        self.total_items = total_items
+        self.shards = [(shard_id, shard_map[shard_id]['upload_url']) for shard_id in sorted(shard_map)]
+        weights = [shard_map[shard_id]['item_count'] for shard_id in sorted(shard_map)]
+        total = total_bytes if balance == SHARD_BALANCE_BYTES else total_items
+        # the offset (in bytes or files) into the job at which each shard ends
+        self.boundaries = []
+        cumulative = 0
+        for weight in weights:
+            cumulative += weight
+            self.boundaries.append(total * cumulative / float(sum(weights) or 1))
+        self.offset = 0
+        self.placed = 0
+        self.last_index = -1
+        self.bytes_per_shard = [0] * len(self.shards)
+
+    def place(self, size):
+        """ returns the (shard_id, upload_url) of the shard the next file of $size bytes goes to """
+        weight = size if self.balance == SHARD_BALANCE_BYTES else 1
+        # a file goes to the shard that holds its midpoint
+        index = bisect.bisect_right(self.boundaries, self.offset + weight / 2.0)
+        # but never goes back to an earlier shard, never skips a shard (a single file bigger than
+        # a shard's share would leave the next shard empty) and moves on when the files left are
+        # only just enough to give each of the remaining shards one
+        files_left = self.total_items - self.placed
+        index = max(index, self.last_index, len(self.shards) - files_left)
+        index = min(index, self.last_index + 1, len(self.shards) - 1)
+        self.last_index = index
+        self.placed += 1
+        self.offset += weight
+        self.bytes_per_shard[index] += size
+        return self.shards[index]
+
+class JobStore(object):
+    """
+    sqlite store (in WAL mode) of the per-file parameters that assign_job_ids schedules and
+    register_jobs reads back, indexed by key and by (job_id, shard_id). Writes are committed
+    in batches rather than once per file.
+    """
+
+    BATCH_SIZE = 10000
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS items (key TEXT PRIMARY KEY, job_id TEXT, "
+                          "shard_id TEXT, params BLOB)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_job_shard ON items (job_id, shard_id)")
+        # content-addressed index of every file we've registered or posted, keyed by its SHA1 and the
+        # target (see upload_target()) it went to. Indexes from before targets were recorded are dropped,
+        # as there's no telling which server or Box their files were posted to
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(content)")]
+        if columns and 'target' not in columns:
+            self.conn.execute("DROP TABLE content")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS content (sha1 TEXT, target TEXT, job_id TEXT, "
+                          "shard_id TEXT, filename TEXT, status TEXT, PRIMARY KEY (sha1, target))")
+        # the running 429 rate of each Box, see BoxBalancer
+        self.conn.execute("CREATE TABLE IF NOT EXISTS box_rates (device_id TEXT PRIMARY KEY, rate REAL)")
+        self.conn.commit()
+
+    def put_many(self, items):
+        """ store the params dicts in $items, all in a single transaction """
+        rows = [(params['key'], params.get('job_id'), params.get('shard_id'),
+                 sqlite3.Binary(cPickle.dumps(params, cPickle.HIGHEST_PROTOCOL))) for params in items]
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO items (key, job_id, shard_id, params) "
+                                      "VALUES (?, ?, ?, ?)", rows)
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT params FROM items WHERE key=?", (key,)).fetchone()
+        return cPickle.loads(str(row[0])) if row else None
+
+    def shard_items(self, job_id, shard_id):
+        """ returns the params of all files assigned to shard $shard_id of job $job_id """
+        with self.lock:
+            rows = self.conn.execute("SELECT params FROM items WHERE job_id=? AND shard_id=?",
+                                     (job_id, shard_id)).fetchall()
+        return [cPickle.loads(str(row[0])) for row in rows]
+
+    def register_content(self, job_id, shard_id, rows, target):
+        """ record the files of a shard registered for $target, keyed by hash, unless they were already posted """
+        with self.lock:
+            with self.conn:
+                for params in rows:
+                    values = (job_id, shard_id, HashCache.path_key(params['filename']), CONTENT_REGISTERED,
+                              params['key'], target)
+                    self.conn.execute("UPDATE content SET job_id=?, shard_id=?, filename=?, status=? "
+                                      "WHERE sha1=? AND target=? AND status!=?", values + (CONTENT_POSTED,))
+                    self.conn.execute("INSERT OR IGNORE INTO content (job_id, shard_id, filename, status, sha1, "
+                                      "target) VALUES (?, ?, ?, ?, ?, ?)", values)
+
+    def content_posted(self, sha1, filename, target):
+        with self.lock:
+            with self.conn:
+                self.conn.execute("UPDATE content SET status=? WHERE sha1=? AND target=?",
+                                  (CONTENT_POSTED, sha1, target))
+                self.conn.execute("INSERT OR IGNORE INTO content (sha1, target, filename, status) VALUES (?, ?, ?, ?)",
+                                  (sha1, target, HashCache.path_key(filename), CONTENT_POSTED))
+
+    def content(self, sha1, targets):
+        """
+        returns (job_id, shard_id, filename, status) of the file with hash $sha1 registered for or posted to
+        any of $targets, or None. Posted files come first
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT job_id, shard_id, filename, status FROM content WHERE sha1=? AND "
+                                    "target IN (%s) ORDER BY status=? DESC" % ', '.join('?' * len(targets)),
+                                    (sha1,) + tuple(targets) + (CONTENT_POSTED,)).fetchone()
+        if not row:
+            return None
+        # file names are stored as the raw bytes of the path
+        job_id, shard_id, filename, status = row
+        return job_id, shard_id, str(filename) if isinstance(filename, buffer) else filename, status
+
+    def box_rates(self):
+        """ returns {device_id: 429 rate} as saved by the last run """
+        with self.lock:
+            return dict(self.conn.execute("SELECT device_id, rate FROM box_rates").fetchall())
+
+    def save_box_rates(self, rates):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO box_rates (device_id, rate) VALUES (?, ?)",
+                                      rates.items())
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+def get_job_store():
+    """ returns the JobStore handle, or None if it is disabled through the hook data """
+    global _job_store
+    filename = CAMIO_PARAMS.get('job_store_file', JOB_STORE_DEFAULT_FILE)
+    if not filename:
+        return None
+    with _job_store_lock:
+        if not _job_store:
+            try:
+                _job_store = JobStore(os.path.expanduser(filename))
+            except sqlite3.Error, e:
+                Log.error("unable to open job store (%s), using the importer's database only", filename)
+                Log.error(traceback.format_exc())
+                CAMIO_PARAMS['job_store_file'] = None
+    return _job_store
 
 def assign_job_ids(self, db, unscheduled):
-    item_count = len(unscheduled)
+    """ $unscheduled can be a list or any other iterable (e.g. a generator) of file params """
+    manifest = JobManifest(skip_posted_duplicates(unscheduled))
+    try:
+        return assign_manifest_job_ids(db, manifest)
+    finally:
+        manifest.close()
+
+def assign_manifest_job_ids(db, manifest):
+    if not manifest.count:
+        return None
+    balancer = get_box_balancer()
+    boxes = balancer.split(manifest) if balancer else None
+    if not boxes:
+        job_id = assign_box_job_ids(db, manifest, CAMIO_PARAMS.get('device_id'))
+        start_manifest_prefetch([(CAMIO_PARAMS.get('device_id'), manifest)])
+        return job_id
+    try:
+        job_ids = [assign_box_job_ids(db, box_manifest, device_id, host)
+                   for (host, device_id), box_manifest in boxes]
+        Log.info("registered %d jobs, one per Box: %s", len(job_ids), ', '.join(job_ids))
+        # the runs of the Boxes follow each other, so together they are still in upload order
+        start_manifest_prefetch([(device_id, box_manifest) for (host, device_id), box_manifest in boxes])
+    finally:
+        for box, box_manifest in boxes:
+            box_manifest.close()
+    return job_ids[0]
+
+def assign_box_job_ids(db, manifest, device_id, host=None):
+    """ register the files of $manifest as a job of the Box $device_id (at $host with 'multi_box') """
+    item_count = manifest.count
     # if we have files to upload follow process in https://github.com/CamioCam/Camiolog-Web/issues/4555
     if item_count:        
-        earliest_date = min(params['timestamp'] for params in unscheduled)
-        latest_date = max(dateshift(params['timestamp'], params['duration']) 
-                for params in unscheduled)
-        device_id = CAMIO_PARAMS.get('device_id')
+        earliest_date = manifest.earliest_date
+        latest_date = manifest.latest_date
         camio_account_token = get_access_token()
-        item_average_size_bytes = sum(len(json.dumps(
-                    {'key':params['key'], 
-                     'original_filename': params['filename'], 
-                     'size_MB': params['size']/1e6})) for params in unscheduled)/item_count
+        item_average_size_bytes = manifest.item_average_size_bytes
         cameras = CAMIO_PARAMS.get('registered_cameras', {})
         payload = {
             'device_id':device_id, 
@@ -390,57 +1894,119 @@ def assign_job_ids(self, db, unscheduled):
             Log.error("no job_id returned from registration call to server")
             Log.error("server returned: %r")
             fail("exiting as no means to track job status")
-        n = 0
-        upload_urls = []
-        for shard_id in sorted(shards['shard_map']):
-            shard = shards['shard_map'][shard_id]
-            n += shard['item_count']
-            upload_urls.append((n, shard_id, shard['upload_url']))
-
-        # for debug only 
-        for item in upload_urls:
-            Log.debug("upload item: %r", item[0])
-        Log.debug('len(unscheduled)=%s', len(unscheduled))
+        balance = CAMIO_PARAMS.get('shard_balance', SHARD_BALANCE_BYTES)
+        planner = ShardPlanner(shards['shard_map'], manifest.total_bytes, item_count, balance)
+        Log.debug('number of files to schedule=%s, shards=%d, balanced by %s', item_count, len(planner.shards), balance)
 
         # for each new file to upload store the job_id and the upload_url from the proper shard
-        upload_urls_k = 0
-        total_urls = 0
-        for k, params in enumerate(unscheduled):        
+        store = get_job_store()
+        scheduled = []
+        for params in manifest.items():
             key = params['key']
             params['job_id'] = job_id
-            while k >= upload_urls[upload_urls_k][0]: 
-                Log.debug("upload_urls_k: %r", upload_urls_k)
-                upload_urls_k += 1
-            params['shard_id'] = upload_urls[upload_urls_k][1]
-            params['upload_url'] = upload_urls[upload_urls_k][2]
+            params['shard_id'], params['upload_url'] = planner.place(params['size'])
+            if host:
+                params['box_host'], params['box_device_id'] = host, device_id
             db[key] = params
-            db.sync()
+            if store:
+                scheduled.append(params)
+                if len(scheduled) >= JobStore.BATCH_SIZE:
+                    store.put_many(scheduled)
+                    scheduled = []
+        if store:
+            store.put_many(scheduled)
+        db.sync()
+        for (shard_id, upload_url), shard_bytes in zip(planner.shards, planner.bytes_per_shard):
+            Log.debug("shard %s: %.1f MB to upload", shard_id, shard_bytes / 1e6)
         return job_id
 
-def register_jobs(self, db, jobs):
-    success = True
-    for job_id, shard_id in jobs:
-        rows = filter(lambda params: \
-            (params['job_id'], params['shard_id']) == (job_id, shard_id), db.values()
-        )
-        hash_map = {}
-        for params in rows:
-            hash_map[params['key']] = {
-                'original_filename': params['filename'], 'size_MB': params['size']/1e6
-            }
-        payload = {
-            'job_id': job_id,
-            'shard_id': shard_id,
-            'item_count':len(rows),
-            'hash_map': hash_map
-            }
-        Log.debug("registering job:\n ID=%s\n shard ID=%s\n num items=%d\n file-map=%r", 
-                job_id, shard_id, len(rows), hash_map)
-        url = rows[0]['upload_url']
-        ret = network_request('put', url, json=payload)
-        if not ret.status_code in (200, 204):
-            Log.error("error registering job: %s", job_id)
-            Log.error("server returned: %d", ret.status_code)
-            success = False
-        return success
+def start_manifest_prefetch(manifests):
+    """
+    start hashing the files of $manifests, a list of (device_id, JobManifest) in upload order, ahead of
+    their upload
+    """
+    if int(CAMIO_PARAMS.get('hash_prefetch_depth', HASH_PREFETCH_DEFAULT_DEPTH)) <= 0:
+        return
+    filenames = PathSpool()
+    # files the journal says are posted to their Box are skipped before hashing, post_video_content skips them too
+    for device_id, manifest in manifests:
+        target = upload_target(device_id)
+        for params in manifest.items():
+            if not posted_before(params['filename'], target):
+                filenames.add(params['filename'])
+    if not start_hash_prefetch(filenames):
+        filenames.close()
 
+def index_shards(db, jobs):
+    """ returns {(job_id, shard_id): [params, ...]} for the shards in $jobs, built in one pass """
+    shards = dict((job, []) for job in jobs)
+    store = get_job_store()
+    if store:
+        for job in shards:
+            shards[job] = store.shard_items(*job)
+    # jobs planned without the job store only live in the importer's database
+    missing = set(job for job in shards if not shards[job])
+    if missing:
+        for params in db.values():
+            job = (params.get('job_id'), params.get('shard_id'))
+            if job in missing:
+                shards[job].append(params)
+    return shards
+
+def register_shard(session, job_id, shard_id, rows):
+    """ PUT the hash_map of one shard to its upload url, returns True on success """
+    hash_map = {}
+    for params in rows:
+        hash_map[params['key']] = {
+            'original_filename': params['filename'], 'size_MB': params['size']/1e6
+        }
+    payload = {
+        'job_id': job_id,
+        'shard_id': shard_id,
+        'item_count':len(rows),
+        'hash_map': hash_map
+        }
+    Log.debug("registering job:\n ID=%s\n shard ID=%s\n num items=%d\n file-map=%r", 
+            job_id, shard_id, len(rows), hash_map)
+    url = rows[0]['upload_url']
+    headers = {"Authorization": "token %s" % get_access_token()}
+    try:
+        ret = session.put(url, headers=headers, json=payload)
+    except requests.exceptions.RequestException, e:
+        Log.error("error registering job: %s, shard: %s", job_id, shard_id)
+        Log.error(traceback.format_exc())
+        return False
+    if not ret.status_code in (200, 204):
+        Log.error("error registering job: %s, shard: %s", job_id, shard_id)
+        Log.error("server returned: %d", ret.status_code)
+        return False
+    store = get_job_store()
+    if store:
+        # with 'multi_box' the files of a job are all planned for the same Box
+        device_id = rows[0].get('box_device_id') or CAMIO_PARAMS.get('device_id')
+        store.register_content(job_id, shard_id, rows, upload_target(device_id))
+    return True
+
+def register_jobs(self, db, jobs):
+    jobs = list(jobs)
+    if not jobs:
+        return True
+    shards = index_shards(db, jobs)
+    empty = [job for job in jobs if not shards[job]]
+    for job_id, shard_id in empty:
+        Log.error("no files found for job: %s, shard: %s", job_id, shard_id)
+    jobs = [job for job in jobs if shards[job]]
+    # all shards are registered at once over a shared pool of connections
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=len(jobs) or 1, pool_maxsize=len(jobs) or 1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    pool = ThreadPool(min(len(jobs), REGISTER_JOBS_MAX_CONCURRENCY) or 1)
+    try:
+        results = pool.map(lambda job: register_shard(session, job[0], job[1], shards[job]), jobs)
+    finally:
+        pool.close()
+    for (job_id, shard_id), success in zip(jobs, results):
+        Log.debug("job: %s, shard: %s registered: %r", job_id, shard_id, success)
+    Log.info("registered %d of %d shards", sum(results), len(results) + len(empty))
+    return all(results) and not empty
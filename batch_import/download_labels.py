@@ -24,20 +24,48 @@ Example:
 
     which will write the list of jobs that belong to the user to the file '/tmp/job_list.json'
 
+    To also load the labels into a local index, and later query the index for the images of camera C2_Hi labelled
+    with _ml_human on the 9th of October 2016, without searching the Camio API again:
+
+    python download_labels.py --index_db /tmp/labels.db SjksdkjoowlkjlSDFiwjoijerSDRdsdf
+    python download_labels.py query --index_db /tmp/labels.db --label _ml_human --camera C2_Hi \\
+        --start 2016-10-09T00:00:00 --end 2016-10-10T00:00:00
+
+    To download the labels of all of your completed jobs, 4 jobs at a time, into the directory /tmp/labels, with a
+    combined label index of all of them:
+
+    python download_labels.py --all_completed --concurrent_jobs 4 --output_dir /tmp/labels --index_db /tmp/labels.db
+
+    Labels that were downloaded earlier can be loaded into an index with
+
+    python download_labels.py index --index_db /tmp/labels.db /tmp/job_labels.json
+
 """
 
 
 import os
+import re
 import sys
+import copy
+import time
 import argparse
 import logging
 import traceback
 import json
+import gzip
 import urllib
+import itertools
+import array
+import bisect
+import calendar
+import sqlite3
+import threading
 import requests
+import dateutil.tz
 import dateutil.parser
 import textwrap
 from datetime import datetime,timedelta
+from multiprocessing.pool import ThreadPool
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
@@ -45,6 +73,655 @@ def fail(msg, *args):
     logging.error(msg, *args)
     sys.exit(1)
 
+# the status of a shard that has been completely processed
+SHARD_COMPLETE_STATUS = 'complete'
+# following a job's progress gives up after this many client errors (like a 404 for a wrong job_id) in a row
+PROGRESS_MAX_CLIENT_ERRORS = 3
+
+# a page of search results is asked for this many times, with a smaller page after each failure
+SEARCH_ATTEMPTS = 3
+SEARCH_TIMEOUT_SECONDS = 60
+SEARCH_RETRY_STATUS_CODES = (408, 413, 500, 502, 503, 504)
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dateutil.tz.tzutc())
+
+# the date format of the Camio API, like 2016-10-09T05:10:31.456-0000, which is parsed without dateutil
+API_DATE_REGEX = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?(?:Z|([+-])(\d\d):?(\d\d))?\Z")
+
+def epoch_us(date):
+    """ microseconds since the epoch of $date, a datetime or a date string, which is taken as UTC if it has no offset """
+    if not isinstance(date, datetime):
+        match = API_DATE_REGEX.match(date)
+        if match:
+            year, month, day, hour, minute, second, fraction, sign, offset_hours, offset_minutes = match.groups()
+            seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+            if sign:
+                seconds -= (1 if sign == '+' else -1) * (int(offset_hours) * 3600 + int(offset_minutes) * 60)
+            return seconds * 1000000 + int((fraction or '0').ljust(6, '0'))
+        date = dateutil.parser.parse(date)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=dateutil.tz.tzutc())
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def shard_progress(job):
+    """ returns the fraction of the shards of $job (as returned by /api/jobs) that are complete """
+    shards = job.get('shard_map', {}).values()
+    if not shards:
+        return 0.0
+    return len([shard for shard in shards if shard.get('status') == SHARD_COMPLETE_STATUS]) / float(len(shards))
+
+class JobProgressTracker(object):
+    """
+    follows one or more jobs through segmentation by polling /api/jobs/{job_id} for all of them at once.
+    Polls are conditional (If-None-Match on the job's ETag) so an unchanged job costs an empty 304, and a job
+    whose polls fail backs off exponentially. Every poll writes one json line per job to $output, with the
+    completion rate of the job and an ETA for the job and each of its shards based on the rate so far.
+    $on_complete(job_id) is called as soon as a job is complete (or turns out to have no shards to follow).
+    Following stops with fail() when a job keeps getting client errors or after $timeout seconds (0 for none).
+    """
+
+    def __init__(self, downloader, job_ids, interval=30, max_interval=300, output=sys.stdout, timeout=0,
+                 on_complete=None):
+        self.downloader = downloader
+        self.job_ids = job_ids
+        self.interval = interval
+        self.max_interval = max_interval
+        self.output = output
+        self.timeout = timeout
+        self.on_complete = on_complete
+        # jobs that are complete or can't be followed
+        self.finished = set()
+        self.client_errors = dict((job_id, 0) for job_id in job_ids)
+        self.last_status = {}
+        self.first_seen = {}
+        self.jobs = {}
+        self.etags = {}
+        self.next_poll = dict((job_id, 0) for job_id in job_ids)
+        self.backoff = dict((job_id, interval) for job_id in job_ids)
+        self.completed_at = {}
+
+    def poll(self, job_id):
+        """ refresh the job resource of $job_id, returns True if it changed """
+        headers = {"Authorization": "token %s" % self.downloader.get_access_token()}
+        if self.etags.get(job_id):
+            headers['If-None-Match'] = self.etags[job_id]
+        url = self.downloader.get_job_url(job_id)
+        try:
+            ret = self.downloader.get_session().get(url, headers=headers)
+        except requests.exceptions.RequestException, e:
+            logging.error("error polling job: %s", job_id)
+            logging.debug(traceback.format_exc())
+            ret = None
+        self.last_status[job_id] = ret.status_code if ret is not None else None
+        if ret is not None and 400 <= ret.status_code < 500 and ret.status_code != 429:
+            self.client_errors[job_id] += 1
+        elif ret is not None:
+            self.client_errors[job_id] = 0
+        if ret is not None and ret.status_code == 304:
+            self.backoff[job_id] = self.interval
+            return False
+        if ret is None or ret.status_code not in (200, 204):
+            self.backoff[job_id] = min(self.max_interval, self.backoff[job_id] * 2)
+            logging.info("unable to poll job: %s, backing off for %d seconds", job_id, self.backoff[job_id])
+            return False
+        self.backoff[job_id] = self.interval
+        self.etags[job_id] = ret.headers.get('ETag')
+        first_poll = job_id not in self.jobs
+        self.jobs[job_id] = ret.json()
+        now = time.time()
+        self.first_seen.setdefault(job_id, now)
+        for shard_id, shard in self.jobs[job_id].get('shard_map', {}).items():
+            if shard.get('status') == SHARD_COMPLETE_STATUS and (job_id, shard_id) not in self.completed_at:
+                # shards that were complete before we started watching say nothing about the rate
+                self.completed_at[(job_id, shard_id)] = None if first_poll else now
+        return True
+
+    def progress(self, job_id):
+        """ the completion rate and ETAs of $job_id given what we've seen of it so far """
+        job = self.jobs[job_id]
+        elapsed = time.time() - self.first_seen[job_id]
+        shards = job.get('shard_map', {})
+        total_items = sum(shard.get('item_count', 0) for shard in shards.values())
+        done_items = sum(shard.get('item_count', 0) for (shard_id, shard) in shards.items()
+                         if (job_id, shard_id) in self.completed_at)
+        watched_items = sum(shard.get('item_count', 0) for (shard_id, shard) in shards.items()
+                            if self.completed_at.get((job_id, shard_id)))
+        items_per_second = watched_items / elapsed if elapsed > 0 else 0
+        shard_progress_list = []
+        for shard_id in sorted(shards):
+            shard = shards[shard_id]
+            complete = (job_id, shard_id) in self.completed_at
+            eta = 0 if complete else (shard.get('item_count', 0) / items_per_second if items_per_second else None)
+            shard_progress_list.append(dict(shard_id=shard_id, status=shard.get('status'),
+                                            item_count=shard.get('item_count'), eta_seconds=eta))
+        remaining = total_items - done_items
+        return dict(
+            job_id=job_id,
+            status=job.get('status'),
+            time=datetime.utcnow().isoformat(),
+            progress=shard_progress(job),
+            items_complete=done_items,
+            item_count=total_items,
+            items_per_second=items_per_second,
+            eta_seconds=0 if not remaining else (remaining / items_per_second if items_per_second else None),
+            shards=shard_progress_list,
+        )
+
+    def is_complete(self, job_id):
+        job = self.jobs.get(job_id)
+        return bool(job) and shard_progress(job) == 1.0
+
+    def finish(self, job_id):
+        self.finished.add(job_id)
+        if self.on_complete:
+            self.on_complete(job_id)
+
+    def run(self):
+        """ poll until all jobs are complete, returns the final job resources """
+        pool = ThreadPool(min(len(self.job_ids), 8) or 1)
+        started = time.time()
+        try:
+            while len(self.finished) < len(self.job_ids):
+                now = time.time()
+                waiting = [job_id for job_id in self.job_ids if job_id not in self.finished]
+                if self.timeout and now - started > self.timeout:
+                    fail("jobs still not complete after %d seconds: %s", self.timeout, " ".join(waiting))
+                due = [job_id for job_id in waiting if self.next_poll[job_id] <= now]
+                for job_id, changed in zip(due, pool.map(self.poll, due)):
+                    self.next_poll[job_id] = time.time() + self.backoff[job_id]
+                    if self.client_errors[job_id] >= PROGRESS_MAX_CLIENT_ERRORS:
+                        fail("unable to follow job: %s, the server answered %s to the last %d polls", job_id,
+                             self.last_status[job_id], self.client_errors[job_id])
+                    if job_id not in self.jobs:
+                        continue
+                    self.output.write(json.dumps(self.progress(job_id), sort_keys=True) + "\n")
+                    self.output.flush()
+                    if not self.jobs[job_id].get('shard_map'):
+                        logging.warning("job %s has no shards, its progress can't be followed", job_id)
+                        self.finish(job_id)
+                    elif self.is_complete(job_id):
+                        self.finish(job_id)
+                # finished jobs are never polled again, so only the others decide when to wake up
+                pending = [self.next_poll[job_id] for job_id in self.job_ids if job_id not in self.finished]
+                if pending:
+                    time.sleep(max(0, min(pending) - time.time()))
+        finally:
+            pool.close()
+        return self.jobs
+
+class DownloadCheckpoint(object):
+    """
+    the search cursors of a label download and the size of the output file written up to them. It's saved to
+    $path after every page of search results, so an interrupted download resumes from the last page written
+    instead of starting over. $settings are the options that shape the output and the searches, a checkpoint
+    saved with other settings is ignored.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.state = dict(settings=settings, offset=None, count=0, cursors={})
+
+    def load(self):
+        """ returns True if a checkpoint of an earlier download with the same settings was loaded """
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path) as fh:
+                state = json.load(fh)
+        except (IOError, ValueError):
+            logging.error("unable to read checkpoint file: %s, starting over", self.path)
+            return False
+        if state.get('settings') != self.settings:
+            logging.warning("checkpoint file %s was saved with other options, starting over", self.path)
+            return False
+        self.state = state
+        return True
+
+    def cursor(self, key):
+        return self.state['cursors'].get(key)
+
+    def save(self, offset, count, key, cursor):
+        self.state['offset'], self.state['count'] = offset, count
+        self.state['cursors'][key] = cursor
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as fh:
+            json.dump(self.state, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.name == 'nt' and os.path.exists(self.path):
+            # os.rename doesn't replace existing files on windows
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+
+    def is_complete(self, keys):
+        return all((self.cursor(key) or {}).get('done') for key in keys)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def format_epoch_us(timestamp):
+    """ the date string of $timestamp (microseconds since the epoch) in the format of the Camio search API """
+    date = datetime.utcfromtimestamp(timestamp // 1000000).replace(microsecond=timestamp % 1000000)
+    fraction = "%03d" % (date.microsecond // 1000) if date.microsecond % 1000 == 0 else "%06d" % date.microsecond
+    return "%s.%s-0000" % (date.strftime("%Y-%m-%dT%H:%M:%S"), fraction)
+
+class LabelStore(object):
+    """
+    a compact in-memory store of the labels of a job, keyed by camera and timestamp so images of different
+    cameras with the same timestamp are all kept. Camera names and labels are interned, and the images of
+    each camera are held in arrays of epoch microseconds, offsets and label ids instead of one dict per image.
+    An image that is added again replaces the earlier one.
+    """
+
+    # array typecodes, array('l') is only 32 bits on some platforms and doubles hold epoch microseconds exactly
+    TIMESTAMP_TYPECODE = 'l' if array.array('l').itemsize >= 8 else 'd'
+
+    def __init__(self):
+        self.cameras, self.camera_ids = [], {}
+        self.labels, self.label_ids = [], {}
+        self.images = []
+
+    @staticmethod
+    def intern(value, values, ids):
+        if value not in ids:
+            ids[value] = len(values)
+            values.append(value)
+        return ids[value]
+
+    def add(self, camera, date_created, labels):
+        camera_id = self.intern(camera, self.cameras, self.camera_ids)
+        if camera_id == len(self.images):
+            self.images.append((array.array(self.TIMESTAMP_TYPECODE), array.array('l'), array.array('i')))
+        timestamps, offsets, label_ids = self.images[camera_id]
+        timestamps.append(epoch_us(date_created))
+        offsets.append(len(label_ids))
+        label_ids.extend(self.intern(label, self.labels, self.label_ids) for label in labels)
+
+    def __len__(self):
+        return sum(len(timestamps) for (timestamps, offsets, label_ids) in self.images)
+
+    def camera_images(self, camera):
+        """ yields the (epoch microseconds, labels) of the images of $camera in time order """
+        timestamps, offsets, label_ids = self.images[self.camera_ids[camera]]
+        # a stable sort keeps images added again after the ones they replace
+        order = sorted(xrange(len(timestamps)), key=timestamps.__getitem__)
+        for position, index in enumerate(order):
+            if position + 1 < len(order) and timestamps[order[position + 1]] == timestamps[index]:
+                continue
+            end = offsets[index + 1] if index + 1 < len(offsets) else len(label_ids)
+            yield int(timestamps[index]), [self.labels[label_id] for label_id in label_ids[offsets[index]:end]]
+
+    def write_json(self, fh, header):
+        """ write the store to $fh as a json object of the $header pairs and 'labels': {camera: {date: [labels]}} """
+        fh.write('{\n')
+        for key, value in header:
+            fh.write('  %s: %s,\n' % (json.dumps(key), json.dumps(value)))
+        fh.write('  "labels": {')
+        for camera_index, camera in enumerate(sorted(self.cameras)):
+            fh.write('%s\n    %s: {' % (',' if camera_index else '', json.dumps(camera)))
+            for image_index, (timestamp, labels) in enumerate(self.camera_images(camera)):
+                fh.write('%s\n      "%s": %s' % (',' if image_index else '', format_epoch_us(timestamp), json.dumps(labels)))
+            fh.write('\n    }')
+        fh.write('\n  }\n}\n')
+
+class LabelWriter(object):
+    """
+    writes the labels of a job as they are found, so the labels never pile up in memory. With $ndjson, one
+    json record per image and line is written to $path. Otherwise the records are spooled to $path.partial the
+    same way, and once the download is complete, finish() loads them into a LabelStore and writes them to
+    $path as one json object of labels by camera and timestamp. With $compress the output is gzipped, one gzip
+    member per page, so that it can be cut off after any page. With a $checkpoint the output is synced and
+    the checkpoint saved after every page, and a download that was interrupted is appended to.
+    write() can be called from several search threads at once.
+    """
+
+    def __init__(self, path, job_id, earliest_date, latest_date, ndjson=False, compress=False, checkpoint=None):
+        self.path = path
+        self.job_id = job_id
+        self.earliest_date = earliest_date
+        self.latest_date = latest_date
+        self.ndjson = ndjson
+        self.compress = compress
+        self.checkpoint = checkpoint
+        self.stream_path = self.get_stream_path(path, ndjson)
+        self.count = 0
+        self.lock = threading.Lock()
+        if checkpoint and checkpoint.state['offset'] is not None:
+            # drop whatever was written after the last checkpoint
+            self.fh = open(self.stream_path, 'r+b')
+            self.fh.truncate(checkpoint.state['offset'])
+            self.fh.seek(0, os.SEEK_END)
+            self.count = checkpoint.state['count']
+            logging.info("resuming download of %d images into: %s", self.count, self.stream_path)
+        else:
+            self.fh = open(self.stream_path, 'wb')
+
+    @staticmethod
+    def get_stream_path(path, ndjson):
+        """ the file the records are written to as they are found """
+        return path if ndjson else path + ".partial"
+
+    def write_data(self, data):
+        if not (self.compress and self.ndjson):
+            self.fh.write(data)
+            return
+        member = gzip.GzipFile(filename='', mode='wb', fileobj=self.fh)
+        member.write(data)
+        member.close()
+
+    def write(self, records, key=None, cursor=None):
+        """
+        append $records, a list of (date_created, {'labels': [...], 'camera': {'name': ...}}), found by the
+        search $key which will continue from $cursor
+        """
+        with self.lock:
+            data = [json.dumps(dict(record, job_id=self.job_id, date_created=date_created)) + '\n'
+                    for (date_created, record) in records]
+            self.count += len(data)
+            if data:
+                self.write_data(''.join(data))
+            if self.checkpoint:
+                self.fh.flush()
+                os.fsync(self.fh.fileno())
+                self.checkpoint.save(self.fh.tell(), self.count, key, cursor)
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+
+    def load_store(self):
+        """ a LabelStore of all of the records written """
+        store = LabelStore()
+        with (gzip.open(self.stream_path) if self.compress and self.ndjson else open(self.stream_path)) as fh:
+            for line in fh:
+                record = json.loads(line)
+                store.add(record['camera']['name'], record['date_created'], record['labels'])
+        return store
+
+    def finish(self, bookmarks=None):
+        """
+        write the json object of the spooled records once the download is complete, and the bookmarks of
+        $bookmarks (a BookmarkBuilder) if given, then drop the checkpoint
+        """
+        store = self.load_store() if not self.ndjson or bookmarks is not None else None
+        if not self.ndjson:
+            logging.info("writing labels of %d images to: %s", len(store), self.path)
+            with (gzip.open(self.path, 'wb') if self.compress else open(self.path, 'wb')) as fh:
+                store.write_json(fh, (('job_id', self.job_id), ('earliest_date', self.earliest_date),
+                                      ('latest_date', self.latest_date)))
+        if bookmarks is not None:
+            bookmarks.build(store)
+            logging.info("writing %d bookmarks to: %s", len(bookmarks), bookmarks.path)
+            with open(bookmarks.path, 'w') as fh:
+                bookmarks.write_json(fh, self.job_id)
+        if self.checkpoint:
+            self.checkpoint.remove()
+        if not self.ndjson:
+            os.remove(self.stream_path)
+
+class BookmarkBuilder(object):
+    """
+    merges the labelled images of each camera into bookmarks, the intervals of consecutive images with the same
+    labels that are at most $gap_seconds apart, so a job can be reviewed by jumping from interval to interval
+    instead of from image to image. The bookmarks of a camera don't overlap and are kept in time order, with an
+    index of their start times (in epoch microseconds) to find the bookmark of a moment with a binary search.
+    """
+
+    def __init__(self, path, gap_seconds):
+        self.path = path
+        self.gap_us = int(gap_seconds * 1000000)
+        self.label_sets, self.label_set_ids = [], {}
+        self.cameras = {}
+
+    def build(self, store):
+        """ build the bookmarks of the images in $store, a LabelStore """
+        for camera in store.cameras:
+            intervals = self.cameras[camera] = []
+            for timestamp, labels in store.camera_images(camera):
+                label_set_id = LabelStore.intern(tuple(sorted(set(labels))), self.label_sets, self.label_set_ids)
+                if intervals and intervals[-1][2] == label_set_id and timestamp - intervals[-1][1] <= self.gap_us:
+                    intervals[-1][1] = timestamp
+                    intervals[-1][3] += 1
+                else:
+                    intervals.append([timestamp, timestamp, label_set_id, 1])
+        return self.cameras
+
+    def __len__(self):
+        return sum(len(intervals) for intervals in self.cameras.values())
+
+    def write_json(self, fh, job_id):
+        """
+        write the bookmarks to $fh as a json object with the sets of labels of the bookmarks in 'label_sets', and
+        for every camera the 'index' of bookmark start times and the [start, end, label set, number of images]
+        'intervals' of its bookmarks
+        """
+        fh.write('{\n  "job_id": %s,\n  "gap_seconds": %s,\n' % (json.dumps(job_id), json.dumps(self.gap_us / 1e6)))
+        fh.write('  "label_sets": %s,\n  "cameras": {' % json.dumps([list(label_set) for label_set in self.label_sets]))
+        for camera_index, camera in enumerate(sorted(self.cameras)):
+            intervals = self.cameras[camera]
+            fh.write('%s\n    %s: {\n      "index": %s,\n      "intervals": [' % (
+                ',' if camera_index else '', json.dumps(camera), json.dumps([interval[0] for interval in intervals])))
+            fh.write(','.join('\n        %s' % json.dumps([format_epoch_us(start), format_epoch_us(end), label_set_id, count])
+                              for (start, end, label_set_id, count) in intervals))
+            fh.write('\n      ]\n    }')
+        fh.write('\n  }\n}\n')
+
+def find_bookmark(bookmarks, camera, date):
+    """
+    the [start, end, labels, number of images] of the bookmark of $camera in $bookmarks (loaded from a file written by
+    BookmarkBuilder) that $date falls into or, if it falls between bookmarks, the one before it. None if there is none
+    """
+    camera_bookmarks = bookmarks['cameras'].get(camera)
+    if not camera_bookmarks:
+        return None
+    position = bisect.bisect_right(camera_bookmarks['index'], epoch_us(date)) - 1
+    if position < 0:
+        return None
+    start, end, label_set_id, count = camera_bookmarks['intervals'][position]
+    return [start, end, bookmarks['label_sets'][label_set_id], count]
+
+class LabelMatcher(object):
+    """
+    decides which labels of an image are kept, given a white list and a black list of label patterns. A pattern
+    is either a label, a prefix ending in '*' (like '_ml_*') or a regular expression that has to match the whole
+    label, starting with 're:' (like 're:_color_(red|green)'). Each list is compiled into one set lookup, one
+    startswith() and one regex, and the decision is cached per label, since the same labels come up over and over.
+    """
+
+    def __init__(self, white_list=(), black_list=()):
+        self.white = self.compile(white_list) if white_list else None
+        self.black = self.compile(black_list) if black_list else None
+        self.cache = {}
+
+    @staticmethod
+    def compile(patterns):
+        labels, prefixes, regexes = set(), [], []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                regexes.append('(?:%s)' % pattern[3:])
+            elif pattern.endswith('*'):
+                prefixes.append(pattern[:-1])
+            else:
+                labels.add(pattern)
+        regex = re.compile('(?:%s)\Z' % '|'.join(regexes)) if regexes else None
+        return labels, tuple(prefixes), regex
+
+    @staticmethod
+    def matches(compiled, label):
+        labels, prefixes, regex = compiled
+        return label in labels or (bool(prefixes) and label.startswith(prefixes)) or bool(regex and regex.match(label))
+
+    def keep(self, label):
+        if label not in self.cache:
+            self.cache[label] = (self.white is None or self.matches(self.white, label)) and \
+                                (self.black is None or not self.matches(self.black, label))
+        return self.cache[label]
+
+    def filter(self, labels):
+        if self.white is None and self.black is None:
+            return labels
+        return [label for label in labels if self.keep(label)]
+
+class LabelIndex(object):
+    """
+    a sqlite database of downloaded labels. Every label has an inverted index of the images (camera and
+    timestamp) it was found in, so labels can be queried by label, camera and time range locally instead
+    of searching the Camio API again. An image that is added again has its labels replaced.
+    """
+
+    # the number of image ids to look up the labels of in one query, sqlite allows 999 parameters
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.label_ids = {}
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, job_id TEXT, camera TEXT, "
+                          "timestamp TEXT, epoch_us INTEGER, UNIQUE (camera, timestamp))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_epoch_us ON images (epoch_us)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS images_camera_epoch_us ON images (camera, epoch_us)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS labels (id INTEGER PRIMARY KEY, label TEXT UNIQUE)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS hits (label_id INTEGER, image_id INTEGER, "
+                          "PRIMARY KEY (label_id, image_id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS hits_image_id ON hits (image_id)")
+        self.conn.commit()
+
+    def get_label_id(self, label, create=True):
+        if label not in self.label_ids:
+            if create:
+                self.conn.execute("INSERT OR IGNORE INTO labels (label) VALUES (?)", (label,))
+            row = self.conn.execute("SELECT id FROM labels WHERE label=?", (label,)).fetchone()
+            if not row:
+                return None
+            self.label_ids[label] = row[0]
+        return self.label_ids[label]
+
+    def add(self, job_id, records):
+        """ index $records, a list of (date_created, {'labels': [...], 'camera': {'name': ...}}), of $job_id """
+        with self.lock:
+            for date_created, record in records:
+                camera = record['camera']['name']
+                row = self.conn.execute("SELECT id FROM images WHERE camera=? AND timestamp=?", (camera, date_created)).fetchone()
+                if row:
+                    image_id = row[0]
+                    self.conn.execute("DELETE FROM hits WHERE image_id=?", (image_id,))
+                else:
+                    image_id = self.conn.execute("INSERT INTO images (job_id, camera, timestamp, epoch_us) VALUES (?, ?, ?, ?)",
+                                                 (job_id, camera, date_created, epoch_us(date_created))).lastrowid
+                self.conn.executemany("INSERT OR IGNORE INTO hits (label_id, image_id) VALUES (?, ?)",
+                                      [(self.get_label_id(label), image_id) for label in record['labels']])
+            self.conn.commit()
+
+    def query(self, labels=(), cameras=(), start=None, end=None, match_all=True):
+        """
+        yields the images in [$start, $end) of $cameras that have all of $labels (or any of them unless
+        $match_all) in time order, as ndjson records like the ones written by LabelWriter
+        """
+        where, params = [], []
+        if labels:
+            label_ids = [label_id for label_id in (self.get_label_id(label, create=False) for label in labels) if label_id]
+            if not label_ids or (match_all and len(label_ids) < len(set(labels))):
+                return
+            where.append("id IN (SELECT image_id FROM hits WHERE label_id IN (%s) GROUP BY image_id HAVING COUNT(*) >= ?)"
+                         % ",".join("?" * len(label_ids)))
+            params += label_ids + [len(label_ids) if match_all else 1]
+        if cameras:
+            where.append("camera IN (%s)" % ",".join("?" * len(cameras)))
+            params += list(cameras)
+        if start:
+            where.append("epoch_us >= ?")
+            params.append(epoch_us(start))
+        if end:
+            where.append("epoch_us < ?")
+            params.append(epoch_us(end))
+        cursor = self.conn.execute("SELECT id, job_id, camera, timestamp FROM images %s ORDER BY epoch_us, camera"
+                                   % ("WHERE " + " AND ".join(where) if where else ""), params)
+        while True:
+            images = cursor.fetchmany(self.QUERY_BATCH_SIZE)
+            if not images:
+                break
+            image_labels = dict((image[0], []) for image in images)
+            for image_id, label in self.conn.execute(
+                    "SELECT hits.image_id, labels.label FROM hits JOIN labels ON labels.id = hits.label_id "
+                    "WHERE hits.image_id IN (%s) ORDER BY labels.label" % ",".join("?" * len(images)), image_labels.keys()):
+                image_labels[image_id].append(label)
+            for image_id, job_id, camera, timestamp in images:
+                yield dict(job_id=job_id, date_created=timestamp, camera=dict(name=camera), labels=image_labels[image_id])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def read_label_export(path):
+    """ yields the (job_id, date_created, record) of every image in $path, written by LabelWriter as json or ndjson """
+    with (gzip.open(path) if path.endswith('.gz') else open(path)) as fh:
+        first_line = fh.readline()
+        try:
+            first_record = json.loads(first_line)
+        except ValueError:
+            first_record = None
+        if isinstance(first_record, dict) and 'date_created' in first_record:
+            # one record per line
+            for line in itertools.chain([first_line], fh):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                yield record['job_id'], record['date_created'], record
+            return
+        document = dict(json.loads(first_line + fh.read(), object_pairs_hook=list))
+        for key, value in document['labels']:
+            value = dict(value)
+            if isinstance(value.get('camera'), list) and 'labels' in value:
+                # written by earlier versions of this script, keyed by timestamp only. Kept as pairs, since
+                # images of different cameras can have the same timestamp
+                yield document['job_id'], key, dict(labels=value['labels'], camera=dict(value['camera']))
+                continue
+            for date_created, labels in sorted(value.items()):
+                yield document['job_id'], date_created, dict(labels=labels, camera=dict(name=key))
+
+class PageSizer(object):
+    """
+    the number of results asked for per search request. It doubles while responses come back fast and small,
+    is halved when a response is slow or big or a request fails, and stays below the most results the server
+    returned for a page that had more results after it, so a job takes as few round trips as the server allows.
+    """
+
+    def __init__(self, initial=100, minimum=10, maximum=1000, target_seconds=5.0, max_bytes=8 * 1024 * 1024):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.size = max(minimum, min(initial, maximum))
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def observe(self, requested, returned, more_results, seconds, size):
+        """ a page of $size bytes with $returned of the $requested results came back after $seconds """
+        with self.lock:
+            self.requests += 1
+            if more_results and returned < requested:
+                # the server returns at most this many results per page
+                self.maximum = max(self.minimum, returned)
+            if seconds > self.target_seconds or size > self.max_bytes:
+                self.size = max(self.minimum, self.size // 2)
+            elif seconds < self.target_seconds / 2 and size < self.max_bytes / 2:
+                self.size = self.size * 2
+            self.size = min(self.size, self.maximum)
+            logging.debug("page of %d results took %.2f seconds and %d bytes, next page size: %d", returned, seconds, size, self.size)
+
+    def failed(self, requested, too_big=False):
+        """ a request for $requested results failed, if $too_big because the server won't return that many """
+        with self.lock:
+            self.requests += 1
+            if too_big:
+                self.maximum = max(self.minimum, requested // 2)
+            self.size = max(self.minimum, min(self.size, requested) // 2)
+
 class BatchDownloader(object):
 
     def __init__(self):
@@ -54,63 +731,160 @@ class BatchDownloader(object):
         self.CAMIO_OAUTH_TOKEN_ENVVAR = "CAMIO_OAUTH_TOKEN"
         self.access_token = None
         self.job_id = None
+        self.job_ids = []
         self.job = None
         self.white_labels = []
+        self.label_lists = dict(white={}, black={})
+        self.label_matchers = {}
+        self.session = None
+        self.workers = 1
+        self.concurrent_jobs = 1
+        self.page_sizer = PageSizer()
+        self.writer = None
+        self.checkpoint = None
+        self.index = None
 
         self.parser = argparse.ArgumentParser(
             formatter_class=argparse.RawDescriptionHelpFormatter,
             description = textwrap.dedent(DESCRIPTION), epilog=EXAMPLES
         )
         # positional args
-        self.parser.add_argument('job_id', nargs='?', type=str, help='the ID of the job that you wish to download the labels for')
+        self.parser.add_argument('job_id', nargs='*', type=str,
+                                help='the ID of the job that you wish to download the labels for (or the IDs of several jobs)')
         # optional arguments
         self.parser.add_argument('-o', '--output_file', type=str, default=None,
                                 help="full path to the output file where the resulting labels will \
-                                be stored in json format (default = {{job_id}}_results.json)")
+                                be stored in json format (default = {{job_id}}_results.json). With several jobs, the \
+                                file listing the output files of all jobs (default = jobs_results.json)")
+        self.parser.add_argument('--all_completed', action='store_true',
+                                help='download the labels of all of your jobs whose shards are all complete')
+        self.parser.add_argument('--concurrent_jobs', type=int, default=4,
+                                help='number of jobs whose labels are downloaded at once with several jobs (default = 4)')
+        self.parser.add_argument('--output_dir', type=str, default='',
+                                help='directory to write the output files of each job to with several jobs (default = .)')
         self.parser.add_argument('-a', '--access_token', type=str, help='your Camio OAuth token (if not given we check the CAMIO_OAUTH_TOKEN envvar)')
-        self.parser.add_argument('-w', '--label_white_list', type=str, help='a json list of labels that are whitelisted to be included in the response')
+        self.parser.add_argument('-w', '--label_white_list', type=str,
+                                help="a json list of labels that are whitelisted to be included in the response, or a json \
+                                object of such lists by camera name ('*' for all cameras). A label ending in '*' includes \
+                                all labels starting with it, and one starting with 're:' all labels matching the regex after it")
         self.parser.add_argument('-f', '--label_white_list_file', type=str, help='a file containing a json list of labels that are whitelisted')
+        self.parser.add_argument('-b', '--label_black_list', type=str,
+                                help='a json list (or json object of lists by camera name) of labels to leave out of the response, \
+                                written like the white-list')
+        self.parser.add_argument('--label_black_list_file', type=str, help='a file containing a json list of labels that are blacklisted')
         self.parser.add_argument('-c', '--csv', action='store_true', help='(not implemented yet) set to export in CSV format')
         self.parser.add_argument('-x', '--xml', action='store_true', help='(not implemented yet) set to export in XML format')
+        self.parser.add_argument('-n', '--ndjson', action='store_true',
+                                help='write one json record per line and image instead of a single json object')
+        self.parser.add_argument('-z', '--gzip', action='store_true', help='gzip the output file')
+        self.parser.add_argument('--index_db', type=str,
+                                help='a sqlite database to also load the labels into, to query them later with the query command')
+        self.parser.add_argument('--bookmarks', type=str,
+                                help='a file to also write bookmarks to, the intervals of consecutive images of a camera \
+                                with the same labels, as json')
+        self.parser.add_argument('--bookmark_gap', type=float, default=10,
+                                help='the most seconds between two images of the same bookmark (default = 10)')
+        self.parser.add_argument('--restart', action='store_true',
+                                help='start the download over instead of resuming it from the checkpoint file \
+                                ({{output_file}}.ckpt) of an interrupted earlier run')
+        self.parser.add_argument('-p', '--progress', action='store_true',
+                                help='follow the job until all of its shards are complete, writing its progress to stdout \
+                                as json lines, then download its labels')
+        self.parser.add_argument('--progress_interval', type=int, default=30,
+                                help='seconds between two polls of the job when following its progress (default = 30)')
+        self.parser.add_argument('--progress_timeout', type=int, default=0,
+                                help='seconds after which to stop following jobs that are still not complete, with an \
+                                error (default = 0, no limit)')
+        self.parser.add_argument('-j', '--workers', type=int, default=1,
+                                help='number of searches run at once. With more than 1 the job is split into one search per \
+                                camera and time window (default = 1)')
+        self.parser.add_argument('--page_size', type=int, default=100,
+                                help='number of results asked for in the first search request. It then adapts to how fast \
+                                and how big the responses are (default = 100)')
+        self.parser.add_argument('--max_page_size', type=int, default=1000,
+                                help='the most results asked for in one search request (default = 1000)')
+        self.parser.add_argument('--window_hours', type=float, default=24,
+                                help='length of the time windows searched at once when --workers is more than 1 (default = 24)')
         self.parser.add_argument('-t', '--testing', action='store_true', help="use Camio testing servers instead of production (for dev use only!)")
         self.parser.add_argument('-v', '--verbose', action='store_true', default=False, help='set logging level to debug')
         self.parser.add_argument('-q', '--quiet', action='store_true', default=False, help='set logging level to errors only')
 
     def parse_argv_or_exit(self):
         self.args = self.parser.parse_args()
-        if not self.args.job_id:
+        if not self.args.job_id and not self.args.all_completed:
             logging.info("no job_id specified, getting list of jobs")
-        self.job_id = self.args.job_id
+        self.job_ids = self.args.job_id
+        self.job_id = self.job_ids[0] if self.is_single_job() else None
+        self.bookmarks_file = self.args.bookmarks
         if not self.args.output_file and self.job_id:
-            self.results_file = "%s_results.json" % self.job_id
+            self.results_file = self.get_results_file(self.job_id)
+        elif not self.args.output_file and not self.is_single_job() and (self.job_ids or self.args.all_completed):
+            self.results_file = os.path.join(self.args.output_dir, "jobs_results.json")
         elif not self.args.output_file:
             self.results_file = "job_list.json"
         else:
             self.results_file = self.args.output_file
+        if self.args.concurrent_jobs < 1:
+            fail("--concurrent_jobs must be positive")
+        self.concurrent_jobs = self.args.concurrent_jobs if not self.is_single_job() else 1
+        if self.args.page_size < 1 or self.args.max_page_size < 1:
+            fail("--page_size and --max_page_size must be positive")
+        self.page_sizer = PageSizer(self.args.page_size, minimum=min(10, self.args.max_page_size), maximum=self.args.max_page_size)
         if self.args.access_token:
             self.access_token = self.args.access_token
+        if self.args.workers < 1 or self.args.window_hours <= 0:
+            fail("--workers and --window_hours must be positive")
+        self.workers = self.args.workers
         if self.args.testing:
             self.CAMIO_SERVER_URL = "https://test.camio.com"
         if self.args.verbose:
             logging.getLogger().setLevel(logging.DEBUG)
         elif self.args.quiet:
             logging.getLogger().setLevel(logging.ERROR)
-        if self.args.label_white_list:
-            try:
-                self.white_labels += json.loads(self.args.white_label_list)
-            except:
-                logging.error("unable to deserialize label white-list")
-                logging.error(traceback.format_exc())
-        if self.args.label_white_list_file:
-            try:
-                with open(self.args.label_white_list_file) as fh:
-                    self.white_labels += json.load(fh)
-            except:
-                logging.error("unable to deserialize label white-list from file: %s", self.args.label_white_list_file)
-                logging.error(traceback.format_exc())
-                
+        for kind in ('white', 'black'):
+            if getattr(self.args, "label_%s_list" % kind):
+                try:
+                    self.add_label_list(kind, json.loads(getattr(self.args, "label_%s_list" % kind)))
+                except:
+                    logging.error("unable to deserialize label %s-list", kind)
+                    logging.error(traceback.format_exc())
+            if getattr(self.args, "label_%s_list_file" % kind):
+                try:
+                    with open(getattr(self.args, "label_%s_list_file" % kind)) as fh:
+                        self.add_label_list(kind, json.load(fh))
+                except:
+                    logging.error("unable to deserialize label %s-list from file: %s", kind, getattr(self.args, "label_%s_list_file" % kind))
+                    logging.error(traceback.format_exc())
+        # the white-list for all cameras only narrows down the search itself when it holds nothing but plain
+        # labels and no camera has a list of its own, otherwise images matching only a pattern or another
+        # camera's list would never come back from the search
+        white_list = self.label_lists['white'].get('*', [])
+        plain = all(not label.endswith('*') and not label.startswith('re:') for label in white_list)
+        per_camera = [camera for camera in self.label_lists['white'] if camera != '*']
+        self.white_labels = list(white_list) if plain and not per_camera else []
+        try:
+            self.get_label_matcher('*')
+            for camera in self.label_lists['white'].keys() + self.label_lists['black'].keys():
+                self.get_label_matcher(camera)
+        except re.error, e:
+            fail("invalid regex in label list: %s", e)
         return self.args
 
+    def add_label_list(self, kind, labels):
+        """ add the $kind ('white' or 'black') list $labels, a list of labels or a dict of them by camera name """
+        if not isinstance(labels, dict):
+            labels = {'*': labels}
+        for camera, camera_labels in labels.items():
+            self.label_lists[kind].setdefault(camera, []).extend(camera_labels)
+
+    def get_label_matcher(self, camera):
+        """ the LabelMatcher of $camera, combining the label lists of $camera with the ones for all cameras """
+        if camera not in self.label_matchers:
+            lists = [self.label_lists[kind].get(camera, []) + (self.label_lists[kind].get('*', []) if camera != '*' else [])
+                     for kind in ('white', 'black')]
+            self.label_matchers[camera] = LabelMatcher(*lists)
+        return self.label_matchers[camera]
+
     def get_access_token(self):
         if not self.access_token:
             token = os.environ.get(self.CAMIO_OAUTH_TOKEN_ENVVAR)
@@ -120,21 +894,47 @@ class BatchDownloader(object):
             self.access_token = token
         return self.access_token
 
-    def gather_all_job_data(self):
-        """ GET /api/jobs to list all job data to user """
+    def get_session(self):
+        """ the requests session shared by all calls to the Camio API, keeping connections alive """
+        if not self.session:
+            self.session = requests.Session()
+            # search results are large and compress well
+            self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+            # keep a connection per worker so concurrent searches don't open and close connections
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(self.workers * self.concurrent_jobs, 10))
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+        return self.session
+
+    def is_single_job(self):
+        return len(self.job_ids) == 1 and not self.args.all_completed
+
+    def get_results_file(self, job_id):
+        """ the default output file of $job_id """
+        results_file = "%s_results.%s" % (job_id, "ndjson" if self.args.ndjson else "json")
+        if self.args.gzip:
+            results_file += ".gz"
+        return results_file if self.is_single_job() else os.path.join(self.args.output_dir, results_file)
+
+    def get_all_jobs(self):
+        """ GET /api/jobs, returns the job resources of all of the user's jobs """
         headers = {"Authorization": "token %s" % self.get_access_token() }
         logging.debug("making GET request to endpoint %s, headers: %r", self.get_job_url(), headers)
-        ret = requests.get(self.get_job_url(), headers=headers)
+        ret = self.get_session().get(self.get_job_url(), headers=headers)
         if not ret.status_code in (200, 204):
             fail("unable to obtain job resource with id: %s from %s endpoint. return code: %r", self.job_id, self.get_job_url(), ret.status_code)
-        parsed = ret.json()
+        return ret.json()
+
+    def gather_all_job_data(self):
+        """ GET /api/jobs to list all job data to user """
+        parsed = self.get_all_jobs()
         jobs = { job['job_id']: {
                     "start_time": job['request'].get('earliest_date'), 
                     "end_time": job['request'].get('latest_date'),
                     "item_count": job['request'].get('item_count'),
                     "status": job['status'],
                     "shard_count": len(job['shard_map']),
-                    #"progress": len(job['shard_map']) / len([shard for shard in job['shard_map'] if shard['status'] == 'complete']),
+                    "progress": shard_progress(job),
                 } for job in parsed
         }
 
@@ -146,57 +946,103 @@ class BatchDownloader(object):
             fh.write(json.dumps(jobs, indent=2, sort_keys=True))
         sys.exit(0)
 
-    def get_job_url(self):
-        if self.job_id:
-            return "%s/%s/%s" % (self.CAMIO_SERVER_URL, self.CAMIO_JOBS_EDNPOINT, self.job_id)
+    def get_job_url(self, job_id=None):
+        job_id = job_id or self.job_id
+        if job_id:
+            return "%s/%s/%s" % (self.CAMIO_SERVER_URL, self.CAMIO_JOBS_EDNPOINT, job_id)
         else:
             return "%s/%s" % (self.CAMIO_SERVER_URL, self.CAMIO_JOBS_EDNPOINT)
 
-    def get_search_url(self, text, date=None):
+    def get_search_url(self, text, date=None, num_results=100):
         endpoint = self.CAMIO_SERVER_URL + "/" + self.CAMIO_SEARCH_ENDPOINT
+        # the '+' of the date's UTC offset would be read as a space if it weren't escaped
+        params = [('text', text), ('num_results', num_results)]
         if date:
-            return "%s?text=%s&num_results=100&date=%s" % (endpoint, text, date.isoformat())
-        else:
-            return "%s?text=%s&num_results=100" %(endpoint, text)
+            params.append(('date', date.isoformat()))
+        return "%s?%s" % (endpoint, urllib.urlencode(params))
 
-    def gather_job_data(self):
-        headers = {"Authorization": "token %s" % self.get_access_token() }
-        logging.debug("making GET request to endpoint %s, headers: %r", self.get_job_url(), headers)
-        ret = requests.get(self.get_job_url(), headers=headers)
-        if not ret.status_code in (200, 204):
-            fail("unable to obtain job resource with id: %s from %s endpoint. return code: %r", self.job_id, self.get_job_url(), ret.status_code)
-        logging.debug("got job-information returned from server:\n%r", ret.text)
-        self.job = ret.json()
+    def gather_job_data(self, job=None):
+        """ GET /api/jobs/{job_id} for the job resource, unless it was already listed as $job """
+        if job:
+            self.job = job
+        else:
+            headers = {"Authorization": "token %s" % self.get_access_token() }
+            logging.debug("making GET request to endpoint %s, headers: %r", self.get_job_url(), headers)
+            ret = self.get_session().get(self.get_job_url(), headers=headers)
+            if not ret.status_code in (200, 204):
+                fail("unable to obtain job resource with id: %s from %s endpoint. return code: %r", self.job_id, self.get_job_url(), ret.status_code)
+            logging.debug("got job-information returned from server:\n%r", ret.text)
+            self.job = ret.json()
         self.earliest_date, self.latest_date = self.job['request']['earliest_date'], self.job['request']['latest_date']
         self.earliest_datetime = dateutil.parser.parse(self.earliest_date)
         self.latest_datetime = dateutil.parser.parse(self.latest_date)
         logging.debug("earliest datetime: %r, latest datetime: %r", self.earliest_datetime, self.latest_datetime)
         self.cameras = [camera['name'] for camera in self.job['request']['cameras']]
-        logging.info("Job Definition:")
+        logging.info("Job Definition: %s", self.job_id)
         logging.info("\tearliest date: %r, latest date: %r", self.earliest_date, self.latest_date)
         logging.info("\tcameras included in inquiry: %s", " ".join(self.cameras))
         return self.job
 
     def make_search_request(self, text, date=None):
+        """
+        GET a page of search results with as many results as the page sizer allows. A request that was too
+        big for the server (or timed out) is retried with a smaller page
+        """
         headers = {"Authorization": "token %s" % self.get_access_token() }
-        url = self.get_search_url(text, date)
-        ret = requests.get(url, headers=headers)
+        for attempt in range(SEARCH_ATTEMPTS):
+            num_results = self.page_sizer.size
+            url = self.get_search_url(text, date, num_results)
+            started = time.time()
+            try:
+                ret = self.get_session().get(url, headers=headers, timeout=SEARCH_TIMEOUT_SECONDS)
+            except requests.exceptions.RequestException, e:
+                logging.error("error while searching with query (%s): %s", text, e)
+                self.page_sizer.failed(num_results)
+                continue
+            if ret.status_code in SEARCH_RETRY_STATUS_CODES and attempt + 1 < SEARCH_ATTEMPTS:
+                logging.info("search with %d results per page failed with status %d, retrying", num_results, ret.status_code)
+                self.page_sizer.failed(num_results, too_big=ret.status_code == 413)
+                continue
+            break
+        else:
+            return None
         if not ret.status_code in (200, 204):
             logging.error("unable to obtain search results with query (%s)", text)
         logging.debug("got search results for query (%s)", text)
         logging.debug("results:\n%r", ret.text)
         try:
-            return ret.json()
+            parsed = ret.json()
         except Exception, e:
             logging.error("error while decoding json response from the server")
             logging.debug("actual response: %r", ret.text)
             return None
+        results = parsed.get('result') if isinstance(parsed, dict) else None
+        if results:
+            returned = sum(len(bucket.get('images', [])) for bucket in results.get('buckets', []))
+            self.page_sizer.observe(num_results, returned, results.get('more_results', False),
+                                    time.time() - started, len(ret.content))
+        return parsed
 
-    def get_results_from_epoch(self, start_time, end_time, camera_names):
+    def get_results_from_epoch(self, start_time, end_time, camera_names, bounded=False, key='all'):
+        """
+        search from $start_time until $end_time, following the search cursor and passing the labels of each
+        page to the label writer. If $bounded, images outside of [$start_time, $end_time) are dropped since
+        they belong to a neighbouring time window. The cursor is checkpointed under $key, and the search
+        resumes from the checkpointed cursor if there is one. Returns the number of images with labels found
+        """
         end_time = dateutil.parser.parse(end_time.isoformat() + "+00:00")
         start_time = dateutil.parser.parse(start_time.isoformat() + "+00:00") 
+        window_start = start_time
         more_results = True
-        labels = dict()
+        count = 0
+        last_page = set()
+        cursor = self.checkpoint.cursor(key) if self.checkpoint else None
+        if cursor:
+            if cursor['done']:
+                return 0
+            start_time = dateutil.parser.parse(cursor['start'])
+            last_page = set(tuple(image) for image in cursor['last_page'])
+            logging.info("resuming search for %s from: %r", " ".join(camera_names), start_time.isoformat())
         while more_results:
             text = " ".join(camera_names)
             text = "all " + text
@@ -207,22 +1053,29 @@ class BatchDownloader(object):
                 break
             results = ret.get('result')
             logging.debug("gathering labels from %d buckets", len(results.get('buckets', [])))
+            records = []
             for index, bucket in enumerate(results.get('buckets')):
                 logging.debug("bucket #%d - for date (%s) found labels: %r", index, bucket['earliest_date'], bucket.get('labels'))
                 for frameidx, image in enumerate(bucket.get('images')):
                     logging.debug("\timage #%d - for date (%s) found labels: %r", frameidx, image['date_created'], image.get('labels'))
-                    if labels.get(image['date_created']):
-                        logging.debug("WARN - duplicate timestamps found, possible bug in iteration")
+                    if (image['date_created'], image['source']) in last_page:
+                        # the page starts where the last one left off, so it can repeat its last images
+                        logging.debug("skipping image already found on the previous page")
+                        continue
                     if not image.get('labels') or len(image['labels']) == 0:
                         continue
-                    new_labels = image['labels']
-                    #if self.white_labels: new_labels = [label for label in new_labels if label in self.white_labels]
-                    labels[image['date_created']] = {
+                    if bounded and not window_start <= dateutil.parser.parse(image['date_created']) < end_time:
+                        continue
+                    new_labels = self.get_label_matcher(image['source']).filter(image['labels'])
+                    if not new_labels:
+                        continue
+                    records.append((image['date_created'], {
                         'labels': new_labels,
                         'camera': {
                             'name': image['source']
                         },
-                    }
+                    }))
+            last_page = set((date_created, record['camera']['name']) for (date_created, record) in records)
             # see if there are more results and if so shift the start time of the query to reflect the new range
             more_results = results.get('more_results', False)
             if more_results and results.get('latest_date_considered'): 
@@ -231,40 +1084,260 @@ class BatchDownloader(object):
                 elif new_start_time >= end_time: more_results = False
                 else: start_time = new_start_time
             
-                logging.info("results gathered, new starting time: %r", start_time.isoformat())
-        return labels
+                logging.info("results gathered for %s, new starting time: %r", " ".join(camera_names), start_time.isoformat())
+            else:
+                more_results = False
+            if self.index:
+                # indexed before the checkpoint is saved, an image that gets indexed twice is just replaced
+                self.index.add(self.job_id, records)
+            self.writer.write(records, key, dict(start=start_time.isoformat(), done=not more_results,
+                                                 last_page=sorted(last_page)))
+            count += len(records)
+        return count
+
+    def get_search_windows(self, start, end):
+        """ split [$start, $end] into windows of --window_hours, returns a list of (start, end, is_last) """
+        window = timedelta(hours=self.args.window_hours)
+        windows = []
+        while start + window < end:
+            windows.append((start, start + window, False))
+            start += window
+        windows.append((start, end, True))
+        return windows
+
+    def get_slice_results(self, search_slice):
+        camera, start, end, is_last = search_slice
+        # the last window isn't bounded above, as images of the last video of the job come after its latest date
+        return self.get_results_from_epoch(start, end, [camera], bounded=not is_last, key=self.get_slice_key(search_slice))
+
+    def get_slice_key(self, search_slice):
+        camera, start, end, is_last = search_slice
+        return "%s/%s" % (camera, start.isoformat())
+
+    def get_slices(self, start, end):
+        return [(camera, window_start, window_end, is_last) for camera in self.cameras
+                for (window_start, window_end, is_last) in self.get_search_windows(start, end)]
+
+    def get_results_parallel(self, start, end):
+        """
+        split the job into one search per camera and time window and run them on --workers threads sharing
+        one session and the label writer, returns the number of images with labels found
+        """
+        slices = self.get_slices(start, end)
+        logging.info("searching %d cameras x time windows with %d workers", len(slices), self.workers)
+        pool = ThreadPool(min(self.workers, len(slices)))
+        try:
+            return sum(pool.imap_unordered(self.get_slice_results, slices))
+        finally:
+            pool.close()
 
     def gather_labels_batch(self):
+        """
+        search the job's time range, writing the labels to the results file as they are found. The searches
+        are checkpointed to {{results_file}}.ckpt, which is removed once all of them are complete
+        """
         start, end = self.earliest_datetime, self.latest_datetime
-        labels = dict(job_id=self.job_id, earliest_date=self.earliest_date, latest_date=self.latest_date, labels={})
         logging.info("gathering over time slot: %r to %r", start.isoformat(), end.isoformat())
-        subset_labels = self.get_results_from_epoch(start, end, self.cameras)
-        labels['labels'].update(subset_labels)
-        logging.debug("\nall found labels:\n%r", json.dumps(labels))
-        logging.info("finished gathering labels")
-        return labels
-
-    def dump_labels_to_file(self):
         logging.info("writing label info to file: %s", self.results_file)
-        with open(self.results_file, 'w') as fh:
-            fh.write(json.dumps(self.labels, indent=2))
+        self.checkpoint = DownloadCheckpoint(self.results_file + ".ckpt", dict(
+            job_id=self.job_id, ndjson=self.args.ndjson, gzip=self.args.gzip, label_lists=self.label_lists,
+            window_hours=self.args.window_hours if self.workers > 1 else None))
+        if not self.args.restart and os.path.exists(LabelWriter.get_stream_path(self.results_file, self.args.ndjson)) \
+                and self.checkpoint.load():
+            logging.info("resuming interrupted download from checkpoint: %s", self.checkpoint.path)
+        self.writer = LabelWriter(self.results_file, self.job_id, self.earliest_date, self.latest_date,
+                                  ndjson=self.args.ndjson, compress=self.args.gzip, checkpoint=self.checkpoint)
+        try:
+            if self.workers > 1:
+                self.get_results_parallel(start, end)
+                keys = [self.get_slice_key(search_slice) for search_slice in self.get_slices(start, end)]
+            else:
+                self.get_results_from_epoch(start, end, self.cameras)
+                keys = ['all']
+        finally:
+            self.writer.close()
+        if not self.checkpoint.is_complete(keys):
+            fail("some searches failed, run the script again to resume the download from: %s", self.checkpoint.path)
+        self.writer.finish(BookmarkBuilder(self.bookmarks_file, self.args.bookmark_gap) if self.bookmarks_file else None)
+        logging.info("finished gathering labels of %d images", self.writer.count)
+        logging.info("search requests made so far: %d, page size: %d", self.page_sizer.requests, self.page_sizer.size)
         logging.info("labels are now available in: %s", self.results_file)
+        return self.writer.count
+
+    def for_job(self, job_id):
+        """ a downloader of the labels of $job_id, sharing the options, session and label index of this one """
+        downloader = copy.copy(self)
+        downloader.job_id = job_id
+        downloader.job_ids = [job_id]
+        downloader.job = downloader.writer = downloader.checkpoint = None
+        downloader.results_file = self.get_results_file(job_id)
+        if self.bookmarks_file:
+            directory, filename = os.path.split(self.bookmarks_file)
+            downloader.bookmarks_file = os.path.join(directory, "%s_%s" % (job_id, filename))
+        return downloader
+
+    def download_job(self, job=None):
+        """ download the labels of this downloader's job, returns its entry in the list of output files of all jobs """
+        result = dict(results_file=self.results_file, bookmarks_file=self.bookmarks_file, status='failed')
+        try:
+            self.gather_job_data(job)
+            result.update(earliest_date=self.earliest_date, latest_date=self.latest_date, cameras=self.cameras,
+                          image_count=self.gather_labels_batch(), status='complete')
+        except SystemExit:
+            # fail() was called, which already logged why
+            pass
+        except Exception, e:
+            logging.error("exception while downloading labels of job: %s", self.job_id)
+            logging.error(traceback.format_exc())
+        return result
+
+    def gather_labels_jobs(self, jobs=None, tracker=None):
+        """
+        download the labels of all jobs, --concurrent_jobs at a time, each into its own output file, and write the
+        list of the output files of all jobs to the results file. $jobs are the job resources by job_id if they
+        were already listed. With a JobProgressTracker, each job is downloaded as soon as the tracker sees it complete
+        """
+        jobs = jobs or {}
+        if self.args.output_dir and not os.path.isdir(self.args.output_dir):
+            logging.info("creating output directory: %s", self.args.output_dir)
+            os.makedirs(self.args.output_dir)
+        downloaders = dict((job_id, self.for_job(job_id)) for job_id in self.job_ids)
+        logging.info("downloading labels of %d jobs, %d at a time", len(downloaders), self.args.concurrent_jobs)
+        pool = ThreadPool(min(self.args.concurrent_jobs, len(downloaders)))
+        try:
+            if tracker:
+                # the job resources listed before following the jobs are out of date, so they're fetched again
+                downloads = {}
+                tracker.on_complete = lambda job_id: downloads.setdefault(
+                    job_id, pool.apply_async(downloaders[job_id].download_job))
+                tracker.run()
+                results = [downloads[job_id].get() for job_id in self.job_ids]
+            else:
+                results = pool.map(lambda job_id: downloaders[job_id].download_job(jobs.get(job_id)), self.job_ids)
+        finally:
+            pool.close()
+        results = dict(zip(self.job_ids, results))
+        logging.info("writing list of output files of all jobs to: %s", self.results_file)
+        with open(self.results_file, 'w') as fh:
+            fh.write(json.dumps(dict(jobs=results, index_db=self.args.index_db), indent=2, sort_keys=True))
+        failed = [job_id for (job_id, result) in results.items() if result['status'] != 'complete']
+        if failed:
+            fail("unable to download the labels of %d jobs, run the script again to resume them: %s", len(failed), " ".join(failed))
+        return results
 
     def run(self):
         try:
             self.parse_argv_or_exit()
-            if not self.job_id:
+            if not self.job_ids and not self.args.all_completed:
                 self.gather_all_job_data()
-            self.job = self.gather_job_data()
-            self.labels = self.gather_labels_batch()
-            self.dump_labels_to_file()
+            jobs = {}
+            if self.args.all_completed:
+                jobs = dict((job['job_id'], job) for job in self.get_all_jobs() if shard_progress(job) == 1.0)
+                self.job_ids = sorted(set(self.job_ids) | set(jobs))
+                if not self.job_ids:
+                    logging.info("none of your jobs is complete yet")
+                    return True
+            if self.args.index_db:
+                logging.info("indexing labels in: %s", self.args.index_db)
+                self.index = LabelIndex(self.args.index_db)
+            try:
+                tracker = None
+                if self.args.progress:
+                    logging.info("following progress of jobs: %s", " ".join(self.job_ids))
+                    tracker = JobProgressTracker(self, self.job_ids, self.args.progress_interval,
+                                                 timeout=self.args.progress_timeout)
+                if self.is_single_job():
+                    if tracker:
+                        tracker.run()
+                    self.job = self.gather_job_data()
+                    self.gather_labels_batch()
+                else:
+                    self.gather_labels_jobs(jobs, tracker)
+            finally:
+                if self.index:
+                    self.index.close()
         except Exception, e:
             logging.error("exception during main program flow")
             logging.error(traceback.format_exc())
             sys.exit(1)
         return  True
 
+class LabelIndexCommand(object):
+    """
+    the 'index' and 'query' commands of this script, which load downloaded labels into a LabelIndex
+    and query it
+    """
+
+    DESCRIPTIONS = {
+        'index': "Loads label files written by this script into a local label index.",
+        'query': "Writes the images in a local label index that have the given labels, cameras and dates as ndjson.",
+    }
+
+    def __init__(self, command):
+        self.command = command
+        self.parser = argparse.ArgumentParser(prog="%s %s" % (os.path.basename(sys.argv[0]), command),
+                                              description=self.DESCRIPTIONS[command], epilog=EXAMPLES,
+                                              formatter_class=argparse.RawDescriptionHelpFormatter)
+        self.parser.add_argument('-d', '--index_db', type=str, required=True, help='the sqlite database of the label index')
+        if command == 'index':
+            self.parser.add_argument('input_files', nargs='+', type=str,
+                                     help='label files written by this script (json or ndjson, optionally gzipped)')
+        else:
+            self.parser.add_argument('-l', '--label', action='append', default=[],
+                                     help='only include images with this label (can be given more than once)')
+            self.parser.add_argument('--any', action='store_true', help='include images with any of the labels instead of all of them')
+            self.parser.add_argument('-c', '--camera', action='append', default=[],
+                                     help='only include images of this camera (can be given more than once)')
+            self.parser.add_argument('--start', type=str, help='only include images at or after this date (UTC unless an offset is given)')
+            self.parser.add_argument('--end', type=str, help='only include images before this date (UTC unless an offset is given)')
+            self.parser.add_argument('-o', '--output_file', type=str,
+                                     help='file to write the matching images to as ndjson (default = stdout)')
+        self.parser.add_argument('-v', '--verbose', action='store_true', default=False, help='set logging level to debug')
+        self.parser.add_argument('-q', '--quiet', action='store_true', default=False, help='set logging level to errors only')
+
+    def index(self, index):
+        for path in self.args.input_files:
+            logging.info("indexing labels from: %s", path)
+            count = 0
+            for job_id, records in itertools.groupby(read_label_export(path), lambda image: image[0]):
+                records = [(date_created, record) for (_, date_created, record) in records]
+                index.add(job_id, records)
+                count += len(records)
+            logging.info("indexed labels of %d images", count)
+
+    def query(self, index):
+        output = open(self.args.output_file, 'w') if self.args.output_file else sys.stdout
+        count = 0
+        try:
+            for record in index.query(self.args.label, self.args.camera, self.args.start, self.args.end, not self.args.any):
+                output.write(json.dumps(record, sort_keys=True) + "\n")
+                count += 1
+        finally:
+            if self.args.output_file:
+                output.close()
+        logging.info("found %d matching images", count)
+
+    def run(self, argv):
+        self.args = self.parser.parse_args(argv)
+        if self.args.verbose:
+            logging.getLogger().setLevel(logging.DEBUG)
+        elif self.args.quiet or (self.command == 'query' and not self.args.output_file):
+            # keep stdout to the query results
+            logging.getLogger().setLevel(logging.ERROR)
+        index = LabelIndex(self.args.index_db)
+        try:
+            getattr(self, self.command)(index)
+        except Exception, e:
+            logging.error("exception during main program flow")
+            logging.error(traceback.format_exc())
+            sys.exit(1)
+        finally:
+            index.close()
+        return True
+
 def main():
+    if sys.argv[1:2] in (['index'], ['query']):
+        return LabelIndexCommand(sys.argv[1]).run(sys.argv[2:])
     return BatchDownloader().run()
 
 if __name__ == '__main__':
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+DESCRIPTION = \
+"""
+This script watches a directory (e.g. the share your NVR exports video to) for new video files and posts each one to
+your Camio Box as soon as it has been fully written, using the same upload path as the camio_hooks.py module does for
+the video importer. It keeps running until it is interrupted.
+
+A file is considered fully written once its size and modification time have stopped changing for --settle_seconds.
+Files that were already posted (as recorded in the upload journal of camio_hooks.py) are not posted again, so the
+script can be stopped and restarted at any time.
+"""
+
+EXAMPLES = \
+"""
+Example:
+
+    Watch ~/nvr_exports for files named like camera1-1493554642.mp4 and post them as they arrive:
+
+    python watch_import.py --regex ".*/(?P<camera>\\w+?)\\-(?P<epoch>\\d+)\\.mp4" \\
+        --hook_data_json_file samples/sample_hook_data.json ~/nvr_exports
+
+    If the filenames contain a formatted date instead of an epoch, capture it as 'timestamp' and give its format:
+
+    python watch_import.py --regex ".*/(?P<camera>\\w+?)_(?P<timestamp>\\d{8}T\\d{6})\\.mp4" \\
+        --timestamp_format "%Y%m%dT%H%M%S" ~/nvr_exports
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import logging
+import argparse
+import datetime
+import textwrap
+import traceback
+
+import camio_hooks
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+def fail(msg, *args):
+    logging.error(msg, *args)
+    sys.exit(1)
+
+class DirectoryWatcher(object):
+    """
+    finds new, fully written files under a directory by polling. Only directories whose mtime changed
+    are listed again, and only the files that are still being written are stat'd on every poll, so
+    a poll of a large share stays cheap.
+    """
+
+    def __init__(self, root, settle_seconds):
+        self.root = root
+        self.settle_seconds = settle_seconds
+        self.directories = {}
+        self.pending = {}
+        self.known = set()
+
+    def poll(self):
+        """ returns the paths of the files that have been fully written since the last poll """
+        directories = [self.root]
+        while directories:
+            dirpath = directories.pop()
+            try:
+                mtime = os.stat(dirpath).st_mtime
+            except OSError:
+                self.directories.pop(dirpath, None)
+                continue
+            listed = self.directories.get(dirpath)
+            if listed and listed[0] == mtime:
+                # nothing was added here, but sub-directories may still have changed
+                directories.extend(listed[1])
+                continue
+            subdirectories = []
+            for filename in os.listdir(dirpath):
+                path = os.path.join(dirpath, filename)
+                if os.path.isdir(path):
+                    subdirectories.append(path)
+                elif path not in self.known:
+                    self.known.add(path)
+                    self.pending[path] = None
+            # a directory changed within the mtime resolution of some filesystems is listed again next time
+            if time.time() - mtime > 2:
+                self.directories[dirpath] = (mtime, subdirectories)
+            directories.extend(subdirectories)
+        ready = []
+        now = time.time()
+        for path, last_seen in self.pending.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                self.known.discard(path)
+                continue
+            seen = (st.st_size, st.st_mtime)
+            if seen == last_seen and now - st.st_mtime >= self.settle_seconds:
+                del self.pending[path]
+                ready.append(path)
+            else:
+                self.pending[path] = seen
+        return sorted(ready)
+
+class WatchImporter(object):
+
+    def __init__(self):
+        self.cameras = {}
+        self.parser = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description = textwrap.dedent(DESCRIPTION), epilog=EXAMPLES
+        )
+        # positional args
+        self.parser.add_argument('input_directory', type=str, help='the directory to watch for new video files')
+        # optional arguments
+        self.parser.add_argument('-r', '--regex', type=str, required=True,
+                                 help="regex matched against the full path of each file, with the named groups 'camera' \
+                                 and either 'epoch' (seconds since 1970, UTC) or 'timestamp'")
+        self.parser.add_argument('--timestamp_format', type=str, default="%Y-%m-%dT%H:%M:%S",
+                                 help="strptime format of the 'timestamp' group (default = %%Y-%%m-%%dT%%H:%%M:%%S)")
+        self.parser.add_argument('--hook_data_json', type=str, help='a json object of hook data passed to camio_hooks')
+        self.parser.add_argument('--hook_data_json_file', type=str, help='a file containing a json object of hook data')
+        self.parser.add_argument('-i', '--interval', type=float, default=5,
+                                 help='seconds between two polls of the directory (default = 5)')
+        self.parser.add_argument('-s', '--settle_seconds', type=float, default=10,
+                                 help='seconds a file must go unchanged before it is posted (default = 10)')
+        self.parser.add_argument('-t', '--testing', action='store_true', help="use Camio testing servers instead of production (for dev use only!)")
+        self.parser.add_argument('-v', '--verbose', action='store_true', default=False, help='set logging level to debug')
+        self.parser.add_argument('-q', '--quiet', action='store_true', default=False, help='set logging level to errors only')
+
+    def parse_argv_or_exit(self):
+        self.args = self.parser.parse_args()
+        if self.args.verbose:
+            logging.getLogger().setLevel(logging.DEBUG)
+        elif self.args.quiet:
+            logging.getLogger().setLevel(logging.ERROR)
+        if not os.path.isdir(self.args.input_directory):
+            fail("input directory does not exist: %s", self.args.input_directory)
+        try:
+            self.regex = re.compile(self.args.regex)
+        except re.error:
+            fail("invalid regex: %s", self.args.regex)
+        if 'camera' not in self.regex.groupindex or \
+                not ('epoch' in self.regex.groupindex or 'timestamp' in self.regex.groupindex):
+            fail("the regex needs a 'camera' group and either an 'epoch' or a 'timestamp' group")
+        hook_data = {}
+        try:
+            if self.args.hook_data_json_file:
+                with open(self.args.hook_data_json_file) as fh:
+                    hook_data.update(json.load(fh))
+            if self.args.hook_data_json:
+                hook_data.update(json.loads(self.args.hook_data_json))
+        except (IOError, ValueError):
+            logging.error(traceback.format_exc())
+            fail("unable to read the hook data")
+        hook_data['logger'] = logging.getLogger()
+        if self.args.testing:
+            hook_data['test'] = True
+        camio_hooks.set_hook_data(hook_data)
+        return self.args
+
+    def parse_filename(self, path):
+        """ returns the (camera_name, timestamp) of $path or None if it doesn't match the regex """
+        match = self.regex.match(path)
+        if not match:
+            return None
+        groups = match.groupdict()
+        if groups.get('epoch'):
+            date = datetime.datetime.utcfromtimestamp(float(groups['epoch']))
+        else:
+            date = datetime.datetime.strptime(groups['timestamp'], self.args.timestamp_format)
+        return groups['camera'], date.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+    def get_camera_id(self, camera_name):
+        if camera_name not in self.cameras:
+            self.cameras[camera_name] = camio_hooks.register_camera(camera_name)['camera_id']
+        return self.cameras[camera_name]
+
+    def register_cameras(self, ready):
+        """
+        register the cameras of the files in $ready that we haven't seen yet with a single request.
+        returns {path: (camera_name, timestamp) or None} for the files whose name could be parsed
+        """
+        parsed = {}
+        for path in ready:
+            try:
+                parsed[path] = self.parse_filename(path)
+            except ValueError:
+                logging.error("unable to parse the timestamp of file: %s", path)
+        camera_names = set(p[0] for p in parsed.values() if p) - set(self.cameras)
+        if camera_names:
+            try:
+                configs = camio_hooks.register_cameras(camera_names)
+            except Exception, e:
+                logging.error("error while registering cameras: %s", ', '.join(sorted(camera_names)))
+                logging.error(traceback.format_exc())
+                configs = {}
+            for camera_name, config in configs.items():
+                # cameras that didn't register are tried again by get_camera_id()
+                if config:
+                    self.cameras[camera_name] = config['camera_id']
+        return parsed
+
+    def post(self, path, parsed):
+        if not parsed:
+            logging.debug("skipping file that doesn't match the regex: %s", path)
+            return
+        camera_name, timestamp = parsed
+        logging.info("posting new file: %s (camera: %s, timestamp: %s)", path, camera_name, timestamp)
+        camio_hooks.post_video_content(camera_name, self.get_camera_id(camera_name), path, timestamp)
+
+    def run(self):
+        self.parse_argv_or_exit()
+        watcher = DirectoryWatcher(self.args.input_directory, self.args.settle_seconds)
+        logging.info("watching directory for new files: %s", self.args.input_directory)
+        try:
+            while True:
+                started = time.time()
+                ready = watcher.poll()
+                parsed = self.register_cameras(ready) if ready else {}
+                for path in ready:
+                    if path not in parsed:
+                        continue
+                    try:
+                        self.post(path, parsed[path])
+                    except Exception, e:
+                        logging.error("error while posting file: %s", path)
+                        logging.error(traceback.format_exc())
+                time.sleep(max(0, self.args.interval - (time.time() - started)))
+        except KeyboardInterrupt:
+            logging.info("stopped watching, waiting for uploads in progress to finish")
+        return camio_hooks.wait_for_uploads()
+
+def main():
+    return WatchImporter().run()
+
+if __name__ == '__main__':
+    main()